@@ -13,6 +13,7 @@ from .parameter import (
     NuisanceParameter,
     IndependentParameter,
     DependentParameter,
+    LinearCombination,
 )
 from .function import (
     BernsteinPoly,
@@ -31,6 +32,7 @@ __all__ = [
     'NuisanceParameter',
     'IndependentParameter',
     'DependentParameter',
+    'LinearCombination',
     'BernsteinPoly',
     'DecorrelatedNuisanceVector',
     '__version__',
@@ -1,11 +1,17 @@
 import numpy as np
 from scipy.special import binom
+from scipy.sparse.csgraph import connected_components
+from collections import OrderedDict
+import hashlib
 import numbers
-from .parameter import IndependentParameter, NuisanceParameter
+from .parameter import IndependentParameter, NuisanceParameter, LinearCombination
 from .util import install_roofit_helpers
 
 
 class BernsteinPoly(object):
+    CoefficientChunkSize = 4096
+    CoefficientCacheSize = 16
+
     def __init__(self, name, order, dim_names=None, init_params=None, limits=None, coefficient_transform=None):
         '''
         Construct a multidimensional Bernstein polynomial
@@ -39,19 +45,17 @@ class BernsteinPoly(object):
             limits = (0., 10.)
         self._transform = coefficient_transform
 
-        # Construct Bernstein matrix for each dimension
-        self._bmatrices = []
-        for idim, n in enumerate(self._order):
-            v = np.arange(n + 1)
-            bmat = np.einsum("l,lv,lv->vl", binom.outer(n, v), binom.outer(v, v), np.power(-1., np.subtract.outer(v, v)))
-            bmat[np.greater.outer(v, v)] = 0  # v > l
-            self._bmatrices.append(bmat)
-
         # Construct parameter tensor
         self._params = np.full(self._shape, None)
         for ipar, initial in np.ndenumerate(self._init_params):
             param = IndependentParameter('_'.join([self.name] + ['%s_par%d' % (d, i) for d, i in zip(self._dim_names, ipar)]), initial, lo=limits[0], hi=limits[1])
             self._params[ipar] = param
+        self._cache = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
 
     @property
     def name(self):
@@ -74,22 +78,75 @@ class BernsteinPoly(object):
                 pnew.intermediate = False
         self._params = newparams
 
-    def coefficients(self, *xvals):
-        # evaluate Bernstein polynomial product tensor
-        bpolyval = np.ones_like(xvals[0])
-        for x, n, B in zip(xvals, self._order, self._bmatrices):
-            xpow = np.power.outer(x, np.arange(n + 1))
-            bpolyval = np.einsum("vl,xl,x...->x...v", B, xpow, bpolyval)
+    def coefficients(self, *xvals, **kwargs):
+        '''
+        Evaluate the Bernstein basis product tensor at each point, returning an array of
+        shape (npoints, order[0]+1, order[1]+1, ...)
+        The basis polynomials are evaluated directly, which stays accurate at high order,
+        in chunks of CoefficientChunkSize points to bound the size of the intermediates.
+        The coefficient transform, if any, is applied chunk by chunk.
+        kwargs:
+            chunked: set true to instead return a generator of the coefficients for consecutive
+                chunks of points, so that very large grids never need to be held in memory
+        '''
+        chunked = kwargs.pop('chunked', False)
+        if len(kwargs) > 0:
+            raise ValueError("Extra keyword arguments supplied!")
+        xvals = [np.asarray(x, dtype=float).reshape(-1) for x in xvals]
+        if chunked:
+            return self._iterCoefficients(xvals)
+        out = np.empty((xvals[0].size,) + self._shape)
+        start = 0
+        for bpolyval in self._iterCoefficients(xvals):
+            out[start:start + len(bpolyval)] = bpolyval
+            start += len(bpolyval)
+        return out
+
+    def _iterCoefficients(self, xvals):
+        for start in range(0, xvals[0].size, self.CoefficientChunkSize):
+            chunk = slice(start, start + self.CoefficientChunkSize)
+            bpolyval = np.ones(xvals[0][chunk].size)
+            for x, n in zip(xvals, self._order):
+                bpolyval = np.einsum("x...,xv->x...v", bpolyval, self._basis(x[chunk], n))
+            if self._transform is not None:
+                bpolyval = self._transform(bpolyval)
+            yield bpolyval
+
+    def _cachedCoefficients(self, xvals):
+        '''
+        The (npoints, nparams) coefficient matrix for a grid, kept in a small LRU cache keyed
+        by the grid contents, as the same grid is typically evaluated many times.
+        Grids larger than one chunk are not cached.
+        '''
+        if xvals[0].size > self.CoefficientChunkSize:
+            return self.coefficients(*xvals).reshape(xvals[0].size, -1)
+        hasher = hashlib.sha1()
+        for x in xvals:
+            hasher.update(np.ascontiguousarray(x, dtype=float).tobytes())
+        key = (xvals[0].size, hasher.hexdigest())
+        try:
+            coefficients = self._cache.pop(key)
+        except KeyError:
+            coefficients = self.coefficients(*xvals).reshape(xvals[0].size, -1)
+            coefficients.setflags(write=False)
+            while self._cache and len(self._cache) >= self.CoefficientCacheSize:
+                self._cache.popitem(last=False)
+        self._cache[key] = coefficients
+        return coefficients
 
-        if self._transform is not None:
-            bpolyval = self._transform(bpolyval)
-        return bpolyval
+    @staticmethod
+    def _basis(x, n):
+        '''
+        The n+1 Bernstein basis polynomials of order n, binom(n, v) x^v (1-x)^(n-v), at each x
+        '''
+        v = np.arange(n + 1)
+        return binom(n, v) * np.power.outer(x, v) * np.power.outer(1. - x, n - v)
 
     def __call__(self, *vals, **kwargs):
         '''
         vals: a ndarray for each dimension's values to evaluate the polynomial at
         kwargs:
-            nominal: set true to evaluate nominal polynomial (rather than create DependentParameter objects)
+            nominal: set true to evaluate nominal polynomial (rather than create LinearCombination objects)
         '''
         nominal = kwargs.pop('nominal', False)
         if len(kwargs) > 0:
@@ -110,25 +167,38 @@ class BernsteinPoly(object):
             xvals.append(x.flatten())
 
         parameters = self._params.reshape(-1)
-        coefficients = self.coefficients(*xvals).reshape(-1, parameters.size)
         if nominal:
-            parameters = np.vectorize(lambda p: p.value)(parameters)
-            return (parameters*coefficients).sum(axis=1).reshape(shape)
+            values = np.fromiter((p.value for p in parameters), dtype=float, count=parameters.size)
+            if xvals[0].size > self.CoefficientChunkSize:
+                out = np.concatenate([c.reshape(len(c), -1).dot(values) for c in self.coefficients(*xvals, chunked=True)])
+            else:
+                out = self._cachedCoefficients(xvals).dot(values)
+            return out.reshape(shape)
+
+        coefficients = self._cachedCoefficients(xvals)
 
+        # one LinearCombination per point, all sharing the flattened parameter tensor
+        dimstrs = ['_'.join(parts) for parts in zip(*(['%s%.3f' % (d, xi) for xi in x] for d, x in zip(self._dim_names, xvals)))]
         out = np.full(coefficients.shape[0], None)
-        for i in range(coefficients.shape[0]):
-            # sum small coefficients first
-            order = np.argsort(coefficients[i])
-            p = np.sum(parameters[order]*coefficients[i][order])
-            dimstr = '_'.join('%s%.3f' % (d, v[i]) for d, v in zip(self._dim_names, xvals))
-            p.name = self.name + '_eval_' + dimstr.replace('.', 'p')
-            p.intermediate = False
-            out[i] = p
+        for i, (dimstr, coef) in enumerate(zip(dimstrs, coefficients)):
+            out[i] = LinearCombination(self.name + '_eval_' + dimstr.replace('.', 'p'), coef, parameters)
         return out.reshape(shape)
 
 
 class DecorrelatedNuisanceVector(object):
-    def __init__(self, prefix, param_in, param_cov):
+    def __init__(self, prefix, param_in, param_cov, tolerance=None):
+        '''
+        Decorrelate a set of parameters with given central values and covariance into one
+        nuisance parameter (with a unit gaussian prior) per eigenmode of the covariance
+            prefix: name prefix of the nuisance parameters
+            param_in: 1D array of central values
+            param_cov: 2D covariance matrix
+            tolerance: optional, drop the smallest eigenmodes as long as their summed variance
+                is below this fraction of the total variance (see discarded_variance)
+        Each correlated parameter is a LinearCombination of the retained nuisance parameters.
+        Independent blocks of a block-diagonal covariance are decomposed separately, so each
+        correlated parameter only depends on the nuisance parameters of its own block.
+        '''
         if not isinstance(param_in, np.ndarray):
             raise ValueError("Expecting param_in to be numpy array")
         if not isinstance(param_cov, np.ndarray):
@@ -139,26 +209,53 @@ class DecorrelatedNuisanceVector(object):
                 and param_cov.shape[1] == param_in.shape[0]):
             raise ValueError("param_in and param_cov have mismatched shapes")
 
-        _, s, v = np.linalg.svd(param_cov)
-        self._transform = np.sqrt(s)[:, None] * v
-        self._parameters = np.array([NuisanceParameter(prefix + str(i), 'param') for i in range(param_in.size)])
-        self._correlated = np.full(self._parameters.shape, None)
-        for i in range(self._parameters.size):
-            coef = self._transform[:, i]
-            order = np.argsort(np.abs(coef))
-            self._correlated[i] = np.sum(self._parameters[order]*coef[order]) + param_in[i]
+        # decompose each connected block of the covariance separately, then order all modes by variance
+        nblocks, self._blocks = connected_components(param_cov != 0, directed=False)
+        s, v, modeblock = [], [], []
+        for block in range(nblocks):
+            idx = np.flatnonzero(self._blocks == block)
+            _, sblock, vblock = np.linalg.svd(param_cov[np.ix_(idx, idx)])
+            vfull = np.zeros((sblock.size, param_in.size))
+            vfull[:, idx] = vblock
+            s.append(sblock)
+            v.append(vfull)
+            modeblock.append(np.full(sblock.size, block))
+        order = np.argsort(-np.concatenate(s), kind='mergesort')
+        s, v, modeblock = np.concatenate(s)[order], np.concatenate(v)[order], np.concatenate(modeblock)[order]
+
+        nkeep = s.size
+        if tolerance is not None:
+            # number of modes needed so that the discarded tail is within tolerance
+            tail = np.cumsum(s[::-1])[::-1]
+            nkeep = max(1, np.count_nonzero(tail > tolerance * s.sum()))
+        self._transform = np.sqrt(s[:nkeep])[:, None] * v[:nkeep]
+        self._discarded = np.diag(param_cov) - np.sum(self._transform**2, axis=0)
+        self._discardedFraction = s[nkeep:].sum() / s.sum() if s.sum() > 0 else 0.
+        self._parameters = np.array([NuisanceParameter(prefix + str(i), 'param') for i in range(nkeep)])
+        blockmodes = [np.flatnonzero(modeblock[:nkeep] == block) for block in range(nblocks)]
+        blockparams = [self._parameters[modes] for modes in blockmodes]
+        self._correlated = np.full(param_in.shape, None)
+        for i in range(param_in.size):
+            block = self._blocks[i]
+            coef = self._transform[blockmodes[block], i]
+            self._correlated[i] = LinearCombination('%s_correlated%d' % (prefix, i), coef, blockparams[block], offset=param_in[i])
+            self._correlated[i].intermediate = True
 
     @classmethod
-    def fromRooFitResult(cls, prefix, fitresult, param_names=None):
+    def fromRooFitResult(cls, prefix, fitresult, param_names=None, tolerance=None):
         install_roofit_helpers()
         names = [p.GetName() for p in fitresult.floatParsFinal()]
         means = fitresult.valueArray()
         cov = fitresult.covarianceArray()
         if param_names is not None:
-            pidx = np.array([names.index(pname) for pname in param_names])
+            index = {name: i for i, name in enumerate(names)}
+            missing = [pname for pname in param_names if pname not in index]
+            if len(missing) > 0:
+                raise ValueError("Parameters %r not found in fit result" % missing)
+            pidx = np.array([index[pname] for pname in param_names], dtype=int)
             means = means[pidx]
             cov = cov[np.ix_(pidx, pidx)]
-        out = cls(prefix, means, cov)
+        out = cls(prefix, means, cov, tolerance=tolerance)
         if param_names is not None:
             for p, name in zip(out.correlated_params, param_names):
                 p.name = name
@@ -171,3 +268,24 @@ class DecorrelatedNuisanceVector(object):
     @property
     def correlated_params(self):
         return self._correlated
+
+    @property
+    def blocks(self):
+        '''
+        The index of the independent block of the covariance that each input parameter belongs to
+        '''
+        return self._blocks
+
+    @property
+    def discarded_variance(self):
+        '''
+        The variance of each input parameter not represented by the retained eigenmodes
+        '''
+        return self._discarded
+
+    @property
+    def discarded_variance_fraction(self):
+        '''
+        The fraction of the total variance (trace of the covariance) in the dropped eigenmodes
+        '''
+        return self._discardedFraction
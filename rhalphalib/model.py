@@ -1,12 +1,14 @@
 from collections import OrderedDict
+import copy
 import datetime
-from functools import reduce
 from itertools import chain
+import json
 import os
 import numpy as np
-from .sample import Sample
-from .parameter import Observable, IndependentParameter
-from .util import _to_numpy, _to_TH1, install_roofit_helpers
+from .sample import Sample, TemplateSample, TransferFactorSample
+from .parameter import Observable, IndependentParameter, NuisanceParameter, ParameterRegistry
+from . import serialize
+from .util import _to_numpy, _to_TH1, _merge_indices, _fingerprint, _render_once, install_roofit_helpers
 
 
 class Model(object):
@@ -16,6 +18,7 @@ class Model(object):
     def __init__(self, name):
         self._name = name
         self._channels = OrderedDict()
+        self._registry = ParameterRegistry()
 
     def __getitem__(self, key):
         if key in self._channels:
@@ -49,7 +52,14 @@ class Model(object):
 
     @property
     def parameters(self):
-        return reduce(set.union, (c.parameters for c in self), set())
+        return set(self.registry)
+
+    @property
+    def registry(self):
+        '''
+        A ParameterRegistry of all parameters in the model
+        '''
+        return self._registry.sync(sample for channel in self for sample in channel)
 
     def addChannel(self, channel):
         if not isinstance(channel, Channel):
@@ -59,21 +69,159 @@ class Model(object):
         self._channels[channel.name] = channel
         return self
 
+    def clone(self, name, replace=None):
+        '''
+        Return a new model named name, sharing the channels, samples and parameters of this one by reference,
+        except for the samples in replace, a dictionary {sample name: new sample or None to remove it}.
+        Only the channels holding a replaced sample are copied, all other channels are the same objects,
+        hence modifying a shared channel or sample (e.g. its mask or effects) affects both models.
+        This is intended for e.g. signal hypothesis scans, see renderCombineHypotheses.
+        '''
+        if replace is None:
+            replace = {}
+        for sampleName, sample in replace.items():
+            if sample is not None and not isinstance(sample, Sample):
+                raise ValueError("Replacement for %s is not a Sample: %r" % (sampleName, sample))
+        replaced = set()
+        out = Model(name)
+        for channel in self:
+            channelReplace = {sampleName: sample for sampleName, sample in replace.items() if sampleName in channel._samples}
+            replaced.update(channelReplace)
+            out.addChannel(channel._replaceSamples(channelReplace) if len(channelReplace) else channel)
+        if replaced != set(replace):
+            raise ValueError("Samples %r to replace not found in %r" % (sorted(set(replace) - replaced), self))
+        return out
+
+    @classmethod
+    def fromChannelBuilder(cls, name, buildChannels, args, processes=None):
+        '''
+        Construct a model from channels built in parallel worker processes
+            buildChannels: a picklable (i.e. module level) function, called as buildChannels(arg) for each arg
+                in args, which returns a Channel or a list of Channels (e.g. the pass and fail regions of a pt bin)
+            processes: number of worker processes (default: number of cpus), or 1 to build in this process
+        The channels are sent back in the format of Model.save.  Parameters are then reconciled by name,
+        so that e.g. a NuisanceParameter or BernsteinPoly coefficient created in several workers is the
+        same object in the returned model.  Intermediate parameters are not reconciled.
+        '''
+        if processes == 1:
+            results = map(_buildChannels, [(buildChannels, arg) for arg in args])
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(processes) as executor:
+                results = list(executor.map(_buildChannels, [(buildChannels, arg) for arg in args]))
+        model = cls(name)
+        shared = {}
+        for data in results:
+            for channel in serialize.loads(data, shared):
+                model.addChannel(channel)
+        return model
+
+    def save(self, path):
+        '''
+        Write the model to path in a compact binary format (see rhalphalib.serialize),
+        which is faster and smaller than pickle, and not limited by the recursion depth
+        '''
+        serialize.save(self, path)
+
+    @classmethod
+    def load(cls, path, mmap_buffers=True):
+        '''
+        Read a model written by Model.save
+            mmap_buffers: if True, the template and effect arrays are copy-on-write memory maps of the file
+        '''
+        model = serialize.load(path, mmap_buffers)
+        if not isinstance(model, cls):
+            raise ValueError("%s does not hold a %s" % (path, cls.__name__))
+        return model
+
+    def getParameterValues(self):
+        '''
+        Return the values of all independent parameters in the model, as an array
+        in the order of the registry independents view (i.e. sorted by name)
+        '''
+        return np.array([p.value for p in self.registry.independents], dtype=float)
+
+    def setParameterValues(self, values, names=None):
+        '''
+        Set the values of independent parameters in the model
+        values: one of
+            - an array of values in the order of the registry independents view, as returned by getParameterValues
+            - an array of values for the parameters given in names
+            - a dictionary {name: value}
+            - a RooFitResult, from which the final values of floating parameters are taken
+        names: an array of parameter names, matching values
+        Names that do not correspond to a parameter in the model are ignored.
+        '''
+        params = self.registry.independents
+        if hasattr(values, 'floatParsFinal'):
+            install_roofit_helpers()
+            values, names = values.valueArray(), values.nameArray()
+        elif isinstance(values, dict):
+            values, names = list(values.values()), list(values.keys())
+        values = np.asarray(values, dtype=float)
+        if names is None:
+            if values.shape != (len(params), ):
+                raise ValueError("Expected %d parameter values, got array of shape %r" % (len(params), values.shape))
+            for p, val in zip(params, values.tolist()):
+                p.value = val
+            return
+        if len(names) != len(values):
+            raise ValueError("Mismatched number of parameter names and values")
+        for i, val in zip(self.registry.index(names).tolist(), values.tolist()):
+            if i >= 0:
+                params[i].value = val
+
     def readRooFitResult(self, res):
         '''
         Update all independent parameters with the values given in the fit result
         res: a RooFitResult object
         '''
         install_roofit_helpers()
-        params = {p.name: p for p in self.parameters if isinstance(p, IndependentParameter)}
+        registry = self.registry
         for p_in in chain(res.floatParsFinal(), res.constPars()):
-            if p_in.GetName() in params:
-                p = params[p_in.GetName()]
+            p = registry.get(p_in.GetName())
+            if isinstance(p, IndependentParameter):
                 p.value = p_in.getVal()
                 p.lo = p_in.getMin()
                 p.hi = p_in.getMax()
                 p.constant = p_in.isConstant()
 
+    def pruneEffects(self, norm_threshold=1e-3, shape_threshold=1e-3):
+        '''
+        Remove negligible nuisance parameter effects from all TemplateSamples in the model
+        See TemplateSample.pruneEffects for the meaning of the thresholds.
+        Returns a report of the removed effects, as a dictionary
+            {channel name: {sample name: [parameter names]}}
+        including only channels and samples where some effect was removed.
+        '''
+        report = OrderedDict()
+        for channel in self:
+            pruned = channel.pruneEffects(norm_threshold, shape_threshold)
+            if len(pruned) > 0:
+                report[channel.name] = pruned
+        return report
+
+    def rebin(self, edges, channels):
+        '''
+        Merge bins of several channels together (see Channel.rebin), as is needed for channels related
+        by a TransferFactorSample, e.g. the pass and fail regions of a measurement
+            edges: the new bin edges of all the channels
+            channels: the names of the channels to rebin
+        The TransferFactorSamples of these channels must depend on samples of these channels.  Their products
+        are fixed before any channel is rebinned, so the result does not depend on the order of the channels.
+        '''
+        channels = [self[name] for name in channels]
+        samples = [sample for channel in channels for sample in channel]
+        transferFactorSamples = [sample for sample in samples if isinstance(sample, TransferFactorSample) and sample.lazy]
+        for sample in transferFactorSamples:
+            if sample.dependentsample not in samples:
+                raise ValueError("%r depends on %r, which is not in the channels to rebin" % (sample, sample.dependentsample))
+        for sample in transferFactorSamples:
+            sample.fixProduct()
+        for channel in channels:
+            channel.rebin(edges)
+
+    @_render_once
     def renderRoofit(self, workspace):
         import ROOT
         install_roofit_helpers()
@@ -104,19 +252,265 @@ class Model(object):
         rooData = workspace.data(dataName)
         return rooSimul, rooData
 
-    def renderCombine(self, outputPath):
+    def renderCard(self, outputFilename, workspaceName, channelWorkspaces=None):
+        '''
+        Write a single multi-bin datacard for all channels, equivalent
+        to what combineCards.py would produce from the per-channel cards
+
+        channelWorkspaces: optional dict of channel name -> workspace name holding
+            that channel's shapes, if not workspaceName.  Unconstrained parameters
+            are always declared from workspaceName.
+        '''
+        if channelWorkspaces is None:
+            channelWorkspaces = {}
+        infos = [(channel, channel._cardInfo()) for channel in self]
+
+        # combine requires signal processes to have id <= 0 and backgrounds > 0,
+        # consistently across all bins
+        signals, backgrounds = [], []
+        for channel, info in infos:
+            for i, process in enumerate(info['processes']):
+                isSignal = i < info['nSig']
+                if process in (backgrounds if isSignal else signals):
+                    raise ValueError("Process %s is signal in some channels and background in others" % process)
+                target = signals if isSignal else backgrounds
+                if process not in target:
+                    target.append(process)
+        processId = {process: i for i, process in enumerate(signals, 1 - len(signals))}
+        processId.update((process, i) for i, process in enumerate(backgrounds, 1))
+
+        # merge nuisances by name, since channels may hold distinct but equivalent parameter objects
+        nuisances = OrderedDict()
+        noCardEffect = OrderedDict()
+        for _, info in infos:
+            for param in info['nuisances']:
+                nuisances.setdefault(param.name, param)
+            for param in info['nuisancesNoCardEffect']:
+                noCardEffect.setdefault(param.name, param)
+        for name in nuisances:
+            noCardEffect.pop(name, None)
+        nuisances = sorted(nuisances.values(), key=lambda p: p.name)
+
+        labels = ['bin', 'process', 'process', 'rate']
+        labels.extend(param.name + ' ' + param.combinePrior for param in nuisances)
+        columns = []
+        for channel, info in infos:
+            entries = {param.name: e for param, e in info['nuisances'].items()}
+            for i, (process, rate) in enumerate(zip(info['processes'], info['rates'])):
+                column = [channel.name, process, str(processId[process]), "%.3f" % rate]
+                column.extend(entries[param.name][i] if param.name in entries else '-' for param in nuisances)
+                columns.append(column)
+
+        with open(outputFilename, "w") as fout:
+            fout.write("# Datacard for %r generated on %s\n" % (self, str(datetime.datetime.now())))
+            fout.write("imax %d # number of categories ('bins' but here we are using shape templates)\n" % len(infos))
+            fout.write("jmax %d # number of samples minus 1\n" % (len(processId) - 1))
+            fout.write("kmax %d # number of nuisance parameters\n" % (len(nuisances) + len(noCardEffect)))
+            for channel, _ in infos:
+                fout.write("shapes * {1} {0}.root {0}:{1}_$PROCESS {0}:{1}_$PROCESS_$SYSTEMATIC\n".format(channelWorkspaces.get(channel.name, workspaceName), channel.name))
+            fout.write("bin %s\n" % " ".join(channel.name for channel, _ in infos))
+            fout.write("observation %s\n" % " ".join("%.3f" % info['observation'] for _, info in infos))
+            _write_table(fout, labels, columns)
+
+            for name in noCardEffect:
+                fout.write("{0} param 0 1\n".format(name))
+
+            for _, info in infos:
+                if info['autoMCStats'] is not None:
+                    fout.write(info['autoMCStats'] + "\n")
+
+            extArgs = OrderedDict()
+            for _, info in infos:
+                for param in info['otherParams']:
+                    extArgs.setdefault(param.name, param)
+            for name in extArgs:
+                fout.write("{0} extArg {1}.root:{1}\n".format(name, workspaceName))
+
+            for _, info in infos:
+                for modifier in info['modifiers']:
+                    fout.write(modifier + "\n")
+
+    def renderCombine(self, outputPath, combined=False, shards=None, processes=None, incremental=False):
+        '''
+        Write the workspace and datacards to outputPath.  If combined is True, the
+        multi-bin card is written directly rather than by combineCards.py in build.sh
+
+        shards: if not None, channels are rendered in parallel into separate files,
+            one per shard, and the cards point to the shard files.  Either the number
+            of shards, or a list of lists of channel names.  The unconstrained parameters
+            shared by all shards are declared from a separate {model}_params.root file.
+        processes: number of worker processes to render shards with (default: number of cpus)
+        incremental: if True, only regenerate the cards and workspace files of channels whose
+            fingerprint differs from that recorded in the manifest of a previous call
+            with the same options and list of channels, and write the manifest for the next call.
+        '''
         import ROOT
         if not os.path.exists(outputPath):
             os.makedirs(outputPath)
-        workspace = ROOT.RooWorkspace(self.name)
-        self.renderRoofit(workspace)
-        workspace.writeToFile(os.path.join(outputPath, "%s.root" % self.name))
-        for channel in self:
-            channel.renderCard(os.path.join(outputPath, "%s.txt" % channel.name), self.name)
+
+        def missing(name):
+            return not os.path.exists(os.path.join(outputPath, name))
+
+        layout = None if shards is None else self._shardLayout(shards)
+        manifestName = os.path.join(outputPath, "manifest.json")
+        manifest, previous = None, None
+        if incremental:
+            # fingerprinting walks all the channels, so it is only done when needed
+            manifest = {
+                'model': self.name,
+                'combined': combined,
+                'shards': layout,
+                'channels': OrderedDict((channel.name, channel.fingerprint()) for channel in self),
+            }
+            if os.path.exists(manifestName):
+                with open(manifestName) as fin:
+                    previous = json.load(fin, object_pairs_hook=OrderedDict)
+        # adding, removing or reordering channels changes the combined card and the (unsharded) workspace,
+        # so only a change to the contents of channels allows re-rendering them selectively
+        if (
+            previous is not None
+            and all(previous.get(k) == manifest[k] for k in ('model', 'combined', 'shards'))
+            and list(previous['channels']) == list(manifest['channels'])
+        ):
+            stale = set(name for name, fp in manifest['channels'].items() if previous['channels'][name] != fp)
+        else:
+            stale = set(channel.name for channel in self)
+
+        if layout is None:
+            workspaceName = self.name
+            channelWorkspaces = {}
+            if len(stale) or missing("%s.root" % workspaceName):
+                workspace = ROOT.RooWorkspace(workspaceName)
+                self.renderRoofit(workspace)
+                workspace.writeToFile(os.path.join(outputPath, "%s.root" % workspaceName))
+        else:
+            workspaceName = self.name + '_params'
+            channelWorkspaces = {name: shard for shard, names in layout.items() for name in names}
+            tasks = [
+                (shard, [self[name] for name in names], outputPath)
+                for shard, names in layout.items()
+                if stale.intersection(names) or missing("%s.root" % shard)
+            ]
+            _renderShards(tasks, processes)
+            if len(stale) or missing("%s.root" % workspaceName):
+                workspace = ROOT.RooWorkspace(workspaceName)
+                for param in self.registry.unconstrained:
+                    param.renderRoofit(workspace)
+                workspace.writeToFile(os.path.join(outputPath, "%s.root" % workspaceName))
+
+        if combined:
+            if len(stale) or missing("%s_combined.txt" % self.name):
+                self.renderCard(os.path.join(outputPath, "%s_combined.txt" % self.name), workspaceName, channelWorkspaces)
+        else:
+            for channel in self:
+                if channel.name in stale or missing("%s.txt" % channel.name):
+                    channel.renderCard(os.path.join(outputPath, "%s.txt" % channel.name), channelWorkspaces.get(channel.name, workspaceName), workspaceName)
+        with open(os.path.join(outputPath, "build.sh"), "w") as fout:
+            if not combined:
+                cstr = " ".join("{0}={0}.txt".format(channel.name) for channel in self)
+                fout.write("combineCards.py %s > %s_combined.txt\n" % (cstr, self.name))
+            fout.write("text2workspace.py %s_combined.txt\n" % self.name)
+        if incremental:
+            with open(manifestName, "w") as fout:
+                json.dump(manifest, fout, indent=1)
+        elif os.path.exists(manifestName):
+            # it no longer describes the files, which could mislead a later incremental call
+            os.remove(manifestName)
+
+    def renderCombineHypotheses(self, outputPath, hypotheses):
+        '''
+        Write a single workspace holding the shapes of this model and of each model in hypotheses
+        (typically clones of this model with a different signal, see clone) to outputPath,
+        along with a multi-bin datacard per model.  Nodes shared between the models are rendered only once.
+        Samples of different models with the same name must be the same object.
+        '''
+        import ROOT
+        if not os.path.exists(outputPath):
+            os.makedirs(outputPath)
+        models = [self] + list(hypotheses)
+        if len(set(model.name for model in models)) != len(models):
+            raise ValueError("Model names are not unique: %r" % [model.name for model in models])
+        samples = {}
+        for model in models:
+            for channel in model:
+                for sample in channel:
+                    if samples.setdefault(sample.name, sample) is not sample:
+                        raise ValueError("Different samples named %s in %r, they cannot share a workspace" % (sample.name, model))
+
+        workspaceName = self.name
+        workspace = ROOT.RooWorkspace(workspaceName)
+        for model in models:
+            for channel in model:
+                for sample in channel:
+                    sample.renderRoofit(workspace)
+                channel._renderObservation(workspace)
+        workspace.writeToFile(os.path.join(outputPath, "%s.root" % workspaceName))
+
         with open(os.path.join(outputPath, "build.sh"), "w") as fout:
-            cstr = " ".join("{0}={0}.txt".format(channel.name) for channel in self)
+            for model in models:
+                model.renderCard(os.path.join(outputPath, "%s_combined.txt" % model.name), workspaceName)
+                fout.write("text2workspace.py %s_combined.txt\n" % model.name)
+
+    def renderCombineStreaming(self, outputPath, channels):
+        '''
+        Render channels one at a time as they are produced, e.g. by a generator, so that the whole model
+        never needs to be in memory.  The channels are not added to this model.
+        Each channel is rendered into its own {model}_{channel}.root workspace file and card as it arrives,
+        after which the workspace and the cached expectation graphs of the channel are released.
+        Only the unconstrained parameters are kept, and declared at the end from a {model}_params.root file.
+        Returns the list of rendered channel names.
+        '''
+        import ROOT
+        if not os.path.exists(outputPath):
+            os.makedirs(outputPath)
+        paramsWorkspaceName = self.name + '_params'
+        names = []
+        unconstrained = OrderedDict()
+        for channel in channels:
+            if not isinstance(channel, Channel):
+                raise ValueError("Only Channel types can be rendered. Got: %r" % channel)
+            if channel.name in names:
+                raise ValueError("Channel name %s was produced twice" % channel.name)
+            workspaceName = "%s_%s" % (self.name, channel.name)
+            workspace = ROOT.RooWorkspace(workspaceName)
+            channel.renderRoofit(workspace)
+            workspace.writeToFile(os.path.join(outputPath, "%s.root" % workspaceName))
+            channel.renderCard(os.path.join(outputPath, "%s.txt" % channel.name), workspaceName, paramsWorkspaceName)
+            for param in channel.registry.unconstrained:
+                unconstrained.setdefault(param.name, param)
+            names.append(channel.name)
+            # the channel may still be referenced by the producer (e.g. by a TransferFactorSample),
+            # so drop its expectation graphs explicitly, they are rebuilt if needed
+            for sample in channel:
+                sample._cache.clear()
+            del workspace, channel
+
+        workspace = ROOT.RooWorkspace(paramsWorkspaceName)
+        for param in unconstrained.values():
+            param.renderRoofit(workspace)
+        workspace.writeToFile(os.path.join(outputPath, "%s.root" % paramsWorkspaceName))
+        with open(os.path.join(outputPath, "build.sh"), "w") as fout:
+            cstr = " ".join("{0}={0}.txt".format(name) for name in names)
             fout.write("combineCards.py %s > %s_combined.txt\n" % (cstr, self.name))
             fout.write("text2workspace.py %s_combined.txt\n" % self.name)
+        return names
+
+    def _shardLayout(self, shards):
+        '''
+        Assign channels to shards, returning an OrderedDict of shard workspace name -> list of channel names
+        shards: either the number of shards, or a list of lists of channel names
+        '''
+        channels = [channel.name for channel in self]
+        if isinstance(shards, int):
+            nshards = max(1, min(shards, len(channels)))
+            shards = [channels[i::nshards] for i in range(nshards)]
+        shards = [list(shard) for shard in shards if len(shard)]
+        assigned = [name for shard in shards for name in shard]
+        if len(set(assigned)) != len(assigned):
+            raise ValueError("A channel was assigned to more than one shard: %r" % assigned)
+        if set(assigned) != set(channels):
+            raise ValueError("Shards %r do not cover all channels of %r" % (assigned, self))
+        return OrderedDict(("%s_shard%d" % (self.name, i), shard) for i, shard in enumerate(shards))
 
 
 class Channel(object):
@@ -131,6 +525,9 @@ class Channel(object):
         self._observable = None
         self._observation = None
         self._mask = None
+        self._autoMCStats = None
+        self._autoMCStatsParams = set()
+        self._registry = ParameterRegistry()
 
     def __getitem__(self, key):
         if key in self._samples:
@@ -162,6 +559,22 @@ class Channel(object):
         sample.mask = self.mask
         self._samples[sample.name] = sample
 
+    def _replaceSamples(self, replace):
+        '''
+        Return a shallow copy of this channel where the samples named in replace are
+        replaced by the given sample (or removed, if None), keeping the sample order
+        '''
+        out = copy.copy(self)
+        out._samples = OrderedDict()
+        out._autoMCStatsParams = set(self._autoMCStatsParams)
+        out._registry = ParameterRegistry()
+        for name, sample in self._samples.items():
+            if name not in replace:
+                out._samples[name] = sample
+            elif replace[name] is not None:
+                out.addSample(replace[name])
+        return out
+
     def setObservation(self, obs, read_sumw2=False):
         '''
         Set the observation of the channel.
@@ -223,7 +636,26 @@ class Channel(object):
 
     @property
     def parameters(self):
-        return reduce(set.union, (s.parameters for s in self), set())
+        return set(self.registry)
+
+    @property
+    def registry(self):
+        '''
+        A ParameterRegistry of all parameters in the channel
+        '''
+        return self._registry.sync(self)
+
+    def fingerprint(self):
+        '''
+        A stable digest of everything that goes into rendering this channel:
+        templates, effects, masks, observation and the parameter graph of all samples.
+        Two channels with equal content have equal fingerprints, even across processes.
+        '''
+        # building the expectation names the per-bin parameters of parametric samples,
+        # so do it now in order to digest the same state before and after rendering
+        for sample in self:
+            sample.getExpectation()
+        return _fingerprint(self)
 
     @property
     def observable(self):
@@ -254,6 +686,153 @@ class Channel(object):
         for sample in self:
             sample.mask = self.mask
 
+    def autoMCStats(self, threshold=0, include_signal=False, hist_mode=1):
+        '''
+        Set MC statistical uncertainties for the channel following the Barlow-Beeston-lite approach of combine.
+        The sumw2 of all TemplateSamples in the channel is combined into a single nuisance parameter per bin
+        when the effective number of events in the bin is above threshold, otherwise one parameter per sample and bin
+        is created.  Combine constrains those per-sample parameters with a poisson prior; the in-model expectation
+        uses a gaussian shape effect of the same width instead, as there is no poisson-constrained effect type.
+        The parameters are named as in combine, and in the datacard they are replaced by the corresponding autoMCStats line.
+            threshold: effective number of unweighted events n = sumw^2/sumw2 above which a bin uses a single parameter
+            include_signal: if True, also include signal samples
+            hist_mode: passed to combine, see combine autoMCStats documentation
+        '''
+        if self._autoMCStats is not None:
+            raise RuntimeError("autoMCStats already set for channel %r" % self)
+        samples = [s for s in self if isinstance(s, TemplateSample) and (include_signal or s.sampletype != Sample.SIGNAL)]
+        for sample in samples:
+            if sample.sumw2 is None:
+                raise ValueError("Sample %r has no sumw2 defined in template" % sample)
+        nominal = np.array([s.getExpectation(nominal=True) for s in samples]).reshape(len(samples), -1)
+        sumw2 = np.array([s.sumw2 for s in samples]).reshape(len(samples), -1)
+        tot_sumw = nominal.sum(axis=0)
+        tot_sumw2 = sumw2.sum(axis=0)
+
+        for i in range(self.observable.nbins):
+            if tot_sumw[i] <= 0. or tot_sumw2[i] <= 0.:
+                continue
+            if tot_sumw[i]**2 / tot_sumw2[i] > threshold:
+                param = NuisanceParameter('prop_bin%s_bin%d' % (self.name, i), combinePrior='shape')
+                relerr = np.sqrt(tot_sumw2[i]) / tot_sumw[i]
+                for sample in samples:
+                    effect_up = np.ones(self.observable.nbins)
+                    effect_down = np.ones(self.observable.nbins)
+                    effect_up[i] = 1. + relerr
+                    effect_down[i] = max(1. - relerr, 0.)
+                    sample.setAutoMCStatsEffect(param, effect_up, effect_down)
+                self._autoMCStatsParams.add(param)
+            else:
+                for sample, w, w2 in zip(samples, nominal[:, i], sumw2[:, i]):
+                    if w <= 0. or w2 <= 0.:
+                        continue
+                    param = NuisanceParameter('prop_bin%s_bin%d_%s' % (self.name, i, sample.name[sample.name.find('_')+1:]), combinePrior='shape')
+                    effect_up = np.ones(self.observable.nbins)
+                    effect_down = np.ones(self.observable.nbins)
+                    effect_up[i] = (w + np.sqrt(w2)) / w
+                    effect_down[i] = max((w - np.sqrt(w2)) / w, 0.)
+                    sample.setAutoMCStatsEffect(param, effect_up, effect_down)
+                    self._autoMCStatsParams.add(param)
+
+        self._autoMCStats = (threshold, include_signal, hist_mode)
+
+    def rebin(self, edges):
+        '''
+        Merge bins of the channel such that the observable binning becomes edges
+        edges: bin edges, which must be a subset of the current observable binning with the same endpoints
+        All samples, their effects, the observation and the mask are merged consistently.
+        A merged bin is masked only if all the bins it contains are masked, and masked bins do not contribute
+        to its content.  If autoMCStats was set, the parameters are recomputed for the new binning.
+        A TransferFactorSample depending on a sample of another channel cannot be rebinned alone,
+        the channels it relates must be rebinned together with Model.rebin.
+        '''
+        for sample in self:
+            if isinstance(sample, TransferFactorSample) and sample.lazy:
+                if sample.dependentsample not in list(self):
+                    raise ValueError("%r depends on %r of another channel, rebin the channels together with Model.rebin" % (sample, sample.dependentsample))
+                # the product must be taken before the dependent sample is merged
+                sample.fixProduct()
+        observable = Observable(self.observable.name, edges)
+        starts = _merge_indices(self.observable.binning, observable.binning)
+        mask = None
+        if self.mask is not None:
+            mask = np.logical_or.reduceat(self.mask, starts)
+        if self._observation is not None:
+            observation = self.getObservation()
+            if isinstance(observation, tuple):
+                self._observation = tuple(np.add.reduceat(obs, starts) for obs in observation)
+            else:
+                self._observation = np.add.reduceat(observation, starts)
+        autoMCStats = self._autoMCStats
+        if autoMCStats is not None:
+            for sample in self:
+                for param in self._autoMCStatsParams & sample.parameters:
+                    sample.removeParamEffect(param)
+            self._autoMCStats = None
+            self._autoMCStatsParams = set()
+        for sample in self:
+            sample.rebin(observable)
+        self._observable = observable
+        self.mask = mask
+        if autoMCStats is not None:
+            self.autoMCStats(*autoMCStats)
+
+    def mergeBins(self, groups=None, min_background=None):
+        '''
+        Merge bins of the channel (see rebin)
+            groups: a list of lists of consecutive bin indices, each list giving the bins to merge into one new bin
+                e.g. [[0, 1], [2], [3, 4, 5]].  All bins must be included, in order.
+            min_background: if groups is None, merge adjacent bins, starting from the first, until the expected
+                background in each new bin is at least this value.  The remaining bins at the end are merged into
+                the last new bin.  Parameteric samples whose nominal expectation cannot be evaluated are not counted.
+        '''
+        nbins = self.observable.nbins
+        if groups is None:
+            if min_background is None:
+                raise ValueError("Either groups or min_background must be specified")
+            background = np.zeros(nbins)
+            for sample in self:
+                if sample.sampletype != Sample.BACKGROUND:
+                    continue
+                try:
+                    background += sample.getExpectation(nominal=True)
+                except NotImplementedError:
+                    continue
+            groups = [[]]
+            total = 0.
+            for i in range(nbins):
+                groups[-1].append(i)
+                total += background[i]
+                if total >= min_background:
+                    groups.append([])
+                    total = 0.
+            leftover = groups.pop()
+            if len(groups) == 0:
+                groups = [leftover]
+            else:
+                groups[-1].extend(leftover)
+        if list(chain.from_iterable(groups)) != list(range(nbins)):
+            raise ValueError("Bin groups must include all %d bins of channel %r consecutively and in order" % (nbins, self))
+        starts = [group[0] for group in groups]
+        self.rebin(self.observable.binning[starts + [nbins]])
+
+    def pruneEffects(self, norm_threshold=1e-3, shape_threshold=1e-3):
+        '''
+        Remove negligible nuisance parameter effects from all TemplateSamples in the channel
+        See TemplateSample.pruneEffects for the meaning of the thresholds.
+        Returns a report of the removed effects, as a dictionary {sample name: [parameter names]}
+        including only samples where some effect was removed.
+        '''
+        report = OrderedDict()
+        for sample in self:
+            if not isinstance(sample, TemplateSample):
+                continue
+            pruned = sample.pruneEffects(norm_threshold, shape_threshold)
+            if len(pruned) > 0:
+                report[sample.name] = [p.name for p in pruned]
+        return report
+
+    @_render_once
     def renderRoofit(self, workspace):
         '''
         Render each sample in the channel and add them into an extended RooAddPdf
@@ -274,70 +853,173 @@ class Channel(object):
 
             rooPdf = ROOT.RooAddPdf(self.name, self.name, ROOT.RooArgList.fromiter(pdfs), ROOT.RooArgList.fromiter(norms))
             workspace.add(rooPdf)
-
-            rooObservable = self.observable.renderRoofit(workspace)
-            rooData = ROOT.RooDataHist(dataName, dataName, ROOT.RooArgList(rooObservable), _to_TH1(self.getObservation(), self.observable.binning, self.observable.name))
-            workspace.add(rooData)
+            self._renderObservation(workspace)
         elif rooPdf == None or rooData == None:  # noqa: E711
             raise RuntimeError('Channel %r has either a pdf or dataset already embedded in workspace %r' % (self, workspace))
         rooPdf = workspace.pdf(self.name)
         rooData = workspace.data(dataName)
         return rooPdf, rooData
 
-    def renderCard(self, outputFilename, workspaceName):
+    def _renderObservation(self, workspace):
+        '''
+        Render the observation as a RooDataHist, if not already in the workspace
+        '''
+        import ROOT
+        install_roofit_helpers()
+        dataName = self.name + '_data_obs'  # combine convention
+        if workspace.data(dataName) == None:  # noqa: E711
+            rooObservable = self.observable.renderRoofit(workspace)
+            rooData = ROOT.RooDataHist(dataName, dataName, ROOT.RooArgList(rooObservable), _to_TH1(self.getObservation(), self.observable.binning, self.observable.name))
+            workspace.add(rooData)
+        return workspace.data(dataName)
+
+    def _cardInfo(self):
+        '''
+        Collect the information needed to write this channel into a datacard
+        '''
         observation = self.getObservation()
         if isinstance(observation, tuple):
             observation = observation[0]
         signalSamples = [s for s in self if s.sampletype == Sample.SIGNAL]
-        nSig = len(signalSamples)
         bkgSamples = [s for s in self if s.sampletype == Sample.BACKGROUND]
-        nBkg = len(bkgSamples)
+        samples = signalSamples + bkgSamples
+
+        registry = self.registry
+        # autoMCStats parameters are declared by a single line in the card
+        nuisanceParams = [p for p in registry.nuisances if p not in self._autoMCStatsParams]
+        otherParams = registry.unconstrained
+
+        # one list of datacard entries per sample, for all nuisances at once
+        effects = [s.combineParamEffects(nuisanceParams) for s in samples]
+        # if a param with prior does not have any effect here, the effect must be embedded in a sample PDF
+        # in that case, we declare it as 'param' later in the card
+        nuisances = OrderedDict()
+        nuisancesNoCardEffect = []
+        for i, param in enumerate(nuisanceParams):
+            if all(e[i] == '-' for e in effects):
+                nuisancesNoCardEffect.append(param)
+            else:
+                nuisances[param] = [e[i] for e in effects]
+
+        # identify any normalization modifiers
+        effects = [s.combineParamEffects(otherParams) for s in samples]
+        modifiers = [e[i] for i in range(len(otherParams)) for e in effects if e[i] != '-']
 
-        params = self.parameters
-        nuisanceParams = [p for p in params if p.hasPrior()]
-        nuisanceParams.sort(key=lambda p: p.name)
-        otherParams = [p for p in params if p not in nuisanceParams]
-        otherParams.sort(key=lambda p: p.name)
+        autoMCStats = None
+        if self._autoMCStats is not None:
+            autoMCStats = "{0} autoMCStats {1} {2:d} {3:d}".format(self.name, self._autoMCStats[0], self._autoMCStats[1], self._autoMCStats[2])
+
+        return {
+            'observation': observation.sum(),
+            'nSig': len(signalSamples),
+            # combine calls 'sample' a 'process', here also we remove channel prefix
+            'processes': [s.name[s.name.find('_')+1:] for s in samples],
+            'rates': [s.combineNormalization() for s in samples],
+            'nuisances': nuisances,
+            'nuisancesNoCardEffect': nuisancesNoCardEffect,
+            'otherParams': otherParams,
+            'modifiers': modifiers,
+            'autoMCStats': autoMCStats,
+        }
+
+    def renderCard(self, outputFilename, workspaceName, extArgWorkspaceName=None):
+        '''
+        Write the datacard for this channel, whose shapes are found in workspaceName.
+        Unconstrained parameters are declared from extArgWorkspaceName, if given.
+        '''
+        if extArgWorkspaceName is None:
+            extArgWorkspaceName = workspaceName
+        info = self._cardInfo()
+        nSig = info['nSig']
+        nBkg = len(info['processes']) - nSig
 
         with open(outputFilename, "w") as fout:
             fout.write("# Datacard for %r generated on %s\n" % (self, str(datetime.datetime.now())))
             fout.write("imax %d # number of categories ('bins' but here we are using shape templates)\n" % 1)
             fout.write("jmax %d # number of samples minus 1\n" % (nSig + nBkg - 1))
-            fout.write("kmax %d # number of nuisance parameters\n" % len(nuisanceParams))
+            fout.write("kmax %d # number of nuisance parameters\n" % (len(info['nuisances']) + len(info['nuisancesNoCardEffect'])))
             fout.write("shapes * {1} {0}.root {0}:{1}_$PROCESS {0}:{1}_$PROCESS_$SYSTEMATIC\n".format(workspaceName, self.name))
             fout.write("bin %s\n" % self.name)
-            fout.write("observation %.3f\n" % observation.sum())
-            table = []
-            table.append(['bin'] + [self.name]*(nSig + nBkg))
-            # combine calls 'sample' a 'process', here also we remove channel prefix
-            table.append(['process'] + [s.name[s.name.find('_')+1:] for s in signalSamples + bkgSamples])
-            table.append(['process'] + [str(i) for i in range(1 - nSig, nBkg + 1)])
-            table.append(['rate'] + ["%.3f" % s.combineNormalization() for s in signalSamples + bkgSamples])
-
-            # if a param with prior does not have any effect here, the effect must be embedded in a sample PDF
-            # in that case, we declare it as 'param' later in the card
-            nuisancesNoCardEffect = []
-            for param in nuisanceParams:
-                effects = [s.combineParamEffect(param) for s in signalSamples + bkgSamples]
-                if all(e == '-' for e in effects):
-                    nuisancesNoCardEffect.append(param)
-                else:
-                    table.append([param.name + ' ' + param.combinePrior] + effects)
-
-            colWidths = [max(len(table[row][col]) + 1 for row in range(len(table))) for col in range(nSig + nBkg + 1)]
-            rowfmt = ("{:<%d}" % colWidths[0]) + " ".join("{:>%d}" % w for w in colWidths[1:]) + "\n"
-            for row in table:
-                fout.write(rowfmt.format(*row))
-
-            for param in nuisancesNoCardEffect:
+            fout.write("observation %.3f\n" % info['observation'])
+
+            labels = ['bin', 'process', 'process', 'rate']
+            columns = [
+                [self.name, process, str(i), "%.3f" % rate]
+                for i, process, rate in zip(range(1 - nSig, nBkg + 1), info['processes'], info['rates'])
+            ]
+            for param, entries in info['nuisances'].items():
+                labels.append(param.name + ' ' + param.combinePrior)
+                for column, entry in zip(columns, entries):
+                    column.append(entry)
+            _write_table(fout, labels, columns)
+
+            for param in info['nuisancesNoCardEffect']:
                 fout.write("{0} param 0 1\n".format(param.name))
 
-            for param in otherParams:
-                fout.write("{0} extArg {1}.root:{1}\n".format(param.name, workspaceName))
+            if info['autoMCStats'] is not None:
+                fout.write(info['autoMCStats'] + "\n")
+
+            for param in info['otherParams']:
+                fout.write("{0} extArg {1}.root:{1}\n".format(param.name, extArgWorkspaceName))
+
+            for modifier in info['modifiers']:
+                fout.write(modifier + "\n")
+
+
+def _buildChannels(task):
+    '''
+    Process pool worker: build channels and return them serialized
+    '''
+    buildChannels, arg = task
+    channels = buildChannels(arg)
+    if isinstance(channels, Channel):
+        channels = [channels]
+    if not all(isinstance(channel, Channel) for channel in channels):
+        raise ValueError("Channel builder %r returned %r, expected Channels" % (buildChannels, channels))
+    return serialize.dumps(list(channels))
+
+
+def _renderShards(tasks, processes=None):
+    '''
+    Render each (workspace name, channels, output path) task, in a process pool if there are several
+    The channels are sent to the workers in the format of Model.save, as pickle may exceed the recursion
+    limit for deep parameter graphs.
+    '''
+    if processes == 1 or len(tasks) <= 1:
+        for task in tasks:
+            _renderShard(task)
+        return
+    import multiprocessing
+    tasks = [(workspaceName, serialize.dumps(channels), outputPath) for workspaceName, channels, outputPath in tasks]
+    pool = multiprocessing.Pool(processes)
+    try:
+        pool.map(_renderShard, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _renderShard(task):
+    '''
+    Process pool worker: render a group of channels into their own workspace file
+    '''
+    import ROOT
+    workspaceName, channels, outputPath = task
+    if isinstance(channels, bytes):
+        channels = serialize.loads(channels)
+    workspace = ROOT.RooWorkspace(workspaceName)
+    for channel in channels:
+        channel.renderRoofit(workspace)
+    filename = os.path.join(outputPath, "%s.root" % workspaceName)
+    workspace.writeToFile(filename)
+    return filename
+
 
-            # identify any normalization modifiers
-            for param in otherParams:
-                for sample in signalSamples + bkgSamples:
-                    effect = sample.combineParamEffect(param)
-                    if effect != '-':
-                        fout.write(effect + "\n")
+def _write_table(fout, labels, columns):
+    '''
+    Write a datacard table, given the row labels and the list of columns
+    '''
+    colWidths = [max(len(entry) for entry in column) + 1 for column in [labels] + columns]
+    rowfmt = ("{:<%d}" % colWidths[0]) + " ".join("{:>%d}" % w for w in colWidths[1:]) + "\n"
+    for row in zip(labels, *columns):
+        fout.write(rowfmt.format(*row))
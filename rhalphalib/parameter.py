@@ -1,10 +1,13 @@
 import numbers
 import warnings
 import numpy as np
-from .util import install_roofit_helpers
+from .util import _render_once, install_roofit_helpers
 
 
 class Parameter(object):
+    # counts renames of any parameter, so that views keyed by name know when to be rebuilt
+    _renames = 0
+
     def __init__(self, name, value):
         self._name = name
         self._value = value
@@ -25,6 +28,7 @@ class Parameter(object):
     @name.setter
     def name(self, name):
         self._name = name
+        Parameter._renames += 1
 
     @property
     def value(self):
@@ -151,6 +155,7 @@ class IndependentParameter(Parameter):
     def constant(self, const):
         self._constant = const
 
+    @_render_once
     def renderRoofit(self, workspace):
         import ROOT
         install_roofit_helpers()
@@ -238,6 +243,7 @@ class DependentParameter(Parameter):
             return "{" + self.name + "}"
         return "(" + self._formula.format(*(p.formula() for p in self._dependents)) + ")"
 
+    @_render_once
     def renderRoofit(self, workspace):
         import ROOT
         install_roofit_helpers()
@@ -272,6 +278,7 @@ class SmoothStep(DependentParameter):
     def formula(self, rendering=False):
         return "{" + self.name + "}"
 
+    @_render_once
     def renderRoofit(self, workspace):
         import ROOT
         install_roofit_helpers()
@@ -286,6 +293,91 @@ class SmoothStep(DependentParameter):
         return workspace.function(self._name)
 
 
+class LinearCombination(DependentParameter):
+    def __init__(self, name, coefficients, parameters, offset=0.):
+        '''
+        A dependent parameter that is a weighted sum of other parameters, offset + sum_i c_i p_i
+            name: name of parameter
+            coefficients: 1D array of weights
+            parameters: 1D object array of parameters, of the same size
+            offset: constant term
+        The parameter array is kept by reference, so many combinations (e.g. the points of
+        a BernsteinPoly evaluated on a grid) can share one parameter tensor.
+        '''
+        super(LinearCombination, self).__init__(name, '')
+        coefficients = np.asarray(coefficients, dtype=float)
+        if coefficients.shape != (len(parameters),):
+            raise ValueError("LinearCombination: coefficients of shape %r do not match %d parameters" % (coefficients.shape, len(parameters)))
+        if not all(isinstance(p, Parameter) for p in parameters):
+            raise ValueError("LinearCombination: expected an array of Parameter instances, got %r" % (parameters, ))
+        self._coefficients = coefficients
+        self._dependents = parameters
+        self._offset = float(offset)
+        self.intermediate = False
+
+    @property
+    def coefficients(self):
+        return self._coefficients
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def value(self):
+        return self._offset + np.dot(self._coefficients, [p.value for p in self._dependents])
+
+    def getDependents(self, rendering=False, deep=False):
+        '''
+        As for DependentParameter, except that parameters with a zero coefficient are left out, as in the formula,
+        and that when rendering, every parameter with a non-zero coefficient is rendered as a term of the sum, even if intermediate
+        '''
+        if not (deep or self.intermediate or rendering):
+            return {self}
+        nonzero = [self._dependents[i] for i in np.flatnonzero(self._coefficients)]
+        if not (deep or self.intermediate):
+            return set(nonzero)
+        dependents = set()
+        for p in nonzero:
+            if deep and isinstance(p, DependentParameter):
+                dependents.update(p.getDependents(deep=True))
+            elif not deep and p.intermediate:
+                dependents.update(p.getDependents())
+            else:
+                dependents.add(p)
+        return dependents
+
+    def formula(self, rendering=False):
+        if not (self.intermediate or rendering):
+            return "{" + self.name + "}"
+        terms = ["%r*%s" % (float(c), p.formula()) for c, p in zip(self._coefficients, self._dependents) if c != 0]
+        if self._offset != 0 or len(terms) == 0:
+            terms.append("%r" % self._offset)
+        return "(" + "+".join(terms) + ")"
+
+    @_render_once
+    def renderRoofit(self, workspace):
+        '''
+        Render as a single RooAddition of coefficient-parameter products, avoiding
+        the TFormula interpretation of a RooFormulaVar with one term per parameter
+        '''
+        import ROOT
+        install_roofit_helpers()
+        if workspace.function(self._name) == None:  # noqa: E711
+            if self.intermediate:
+                warnings.warn("Rendering intermediate parameter: %r" % self, RuntimeWarning)
+                self.intermediate = False
+            nonzero = np.flatnonzero(self._coefficients)
+            rooVars = [self._dependents[i].renderRoofit(workspace) for i in nonzero]
+            rooCoefs = [ROOT.RooConstVar('%s_coef%d' % (self._name, i), '', self._coefficients[i]) for i in nonzero]
+            if self._offset != 0:
+                rooVars.append(ROOT.RooConstVar(self._name + '_offset', '', self._offset))
+                rooCoefs.append(ROOT.RooConstVar(self._name + '_offsetcoef', '', 1.))
+            var = ROOT.RooAddition(self._name, self._name, ROOT.RooArgList.fromiter(rooVars), ROOT.RooArgList.fromiter(rooCoefs))
+            workspace.add(var)
+        return workspace.function(self._name)
+
+
 class Observable(Parameter):
     '''
     A simple struct that holds the name of an observable (e.g. x axis of discriminator histogram) and its binning
@@ -318,6 +410,7 @@ class Observable(Parameter):
         import ROOT
         return ROOT.TArrayD(len(self._binning), self._binning)
 
+    @_render_once
     def renderRoofit(self, workspace):
         '''
         Return a RooObservable following the definition
@@ -332,3 +425,137 @@ class Observable(Parameter):
 
     def formula(self):
         raise RuntimeError("Observables cannot be used in formulas, as this would necessitate support for numeric integration, which is outside the scope of rhalphalib.")
+
+
+class ParameterRegistry(object):
+    '''
+    The set of parameters affecting a collection of samples, kept up to date incrementally
+    Each sample's parameters are only collected again when its version changes.
+    Iteration is in order of parameter name, and parameters can be looked up by name.
+    The name-ordered views are rebuilt when a parameter is added, removed, or renamed.
+    '''
+    def __init__(self):
+        self._sources = {}
+        self._refcounts = {}
+        self._version = 0
+        self._views = None
+        self._viewsRenames = None
+
+    def __getstate__(self):
+        # the bookkeeping is keyed by object identity, hence is rebuilt on the next sync rather than stored
+        state = self.__dict__.copy()
+        state.update(_sources={}, _refcounts={}, _views=None)
+        return state
+
+    def __iter__(self):
+        return iter(self._getViews()['all'])
+
+    def __len__(self):
+        return len(self._refcounts)
+
+    def __contains__(self, name):
+        return name in self._getViews()['byname']
+
+    def __getitem__(self, name):
+        return self._getViews()['byname'][name]
+
+    def get(self, name, default=None):
+        return self._getViews()['byname'].get(name, default)
+
+    def index(self, names):
+        '''
+        Return an array of the positions in the independents view of the parameters with the given names
+        Names that are not found get position -1
+        '''
+        index = self._getViews()['index']
+        return np.array([index.get(name, -1) for name in names], dtype=int)
+
+    @property
+    def version(self):
+        '''
+        A counter that increases every time a parameter is added to or removed from the registry
+        '''
+        return self._version
+
+    @property
+    def nuisances(self):
+        '''
+        Parameters with a prior, sorted by name
+        '''
+        return self._getViews()['nuisances']
+
+    @property
+    def independents(self):
+        '''
+        IndependentParameters (including nuisance parameters), sorted by name
+        '''
+        return self._getViews()['independents']
+
+    @property
+    def unconstrained(self):
+        '''
+        Parameters without a prior (e.g. rate parameters), sorted by name
+        '''
+        return self._getViews()['unconstrained']
+
+    def sync(self, samples):
+        '''
+        Update the registry to hold the parameters of exactly the given samples
+        Returns the registry itself.
+        '''
+        seen = set()
+        for sample in samples:
+            key = id(sample)
+            seen.add(key)
+            source = self._sources.get(key, None)
+            if source is not None and source[1] == sample.version:
+                continue
+            params = sample.parameters
+            # add before removing, so that parameters the sample keeps are not dropped in between
+            self._add(params)
+            if source is not None:
+                self._remove(source[2])
+            self._sources[key] = (sample, sample.version, params)
+        for key in set(self._sources) - seen:
+            self._remove(self._sources.pop(key)[2])
+        return self
+
+    def _add(self, params):
+        for param in params:
+            key = id(param)
+            if key in self._refcounts:
+                self._refcounts[key][1] += 1
+            else:
+                self._refcounts[key] = [param, 1]
+                self._views = None
+                self._version += 1
+
+    def _remove(self, params):
+        for param in params:
+            key = id(param)
+            self._refcounts[key][1] -= 1
+            if self._refcounts[key][1] == 0:
+                del self._refcounts[key]
+                self._views = None
+                self._version += 1
+
+    def _getViews(self):
+        if self._views is None or self._viewsRenames != Parameter._renames:
+            params = sorted((p for p, _ in self._refcounts.values()), key=lambda p: p.name)
+            byname = {}
+            for p in params:
+                byname.setdefault(p.name, p)
+            independents = [p for p in params if isinstance(p, IndependentParameter)]
+            index = {}
+            for i, p in enumerate(independents):
+                index.setdefault(p.name, i)
+            self._views = {
+                'all': params,
+                'byname': byname,
+                'nuisances': [p for p in params if p.hasPrior()],
+                'independents': independents,
+                'index': index,
+                'unconstrained': [p for p in params if not p.hasPrior()],
+            }
+            self._viewsRenames = Parameter._renames
+        return self._views
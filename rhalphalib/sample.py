@@ -1,5 +1,6 @@
 from __future__ import division
 import numpy as np
+import scipy.sparse
 import numbers
 import warnings
 from .parameter import (
@@ -10,7 +11,7 @@ from .parameter import (
     SmoothStep,
     Observable,
 )
-from .util import _to_numpy, _to_TH1, _pairwise_sum, install_roofit_helpers
+from .util import _to_numpy, _to_TH1, _merge_indices, _pairwise_sum, _render_once, install_roofit_helpers
 
 
 class Sample(object):
@@ -24,6 +25,13 @@ class Sample(object):
         self._sampletype = sampletype
         self._observable = None
         self._mask = None
+        self._version = 0
+        self._cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
 
     def __repr__(self):
         return "<%s (%s) instance at 0x%x>" % (
@@ -50,6 +58,27 @@ class Sample(object):
     def observable(self, obs):
         # TODO check compatible?
         self._observable = obs
+        self._modified()
+
+    @property
+    def version(self):
+        '''
+        A counter that increases every time the sample is modified, e.g. when setting an effect or mask
+        '''
+        return self._version
+
+    def _modified(self):
+        self._version += 1
+
+    def _cached(self, key, build):
+        '''
+        Return the result of build(), reusing the previous result if the sample was not modified since
+        '''
+        version, value = self._cache.get(key, (None, None))
+        if version != self.version:
+            value = build()
+            self._cache[key] = (self.version, value)
+        return value
 
     @property
     def parameters(self):
@@ -74,6 +103,7 @@ class Sample(object):
         elif mask is not None:
             raise ValueError("Mask should be None or a numpy array")
         self._mask = mask
+        self._modified()
 
     def setParamEffect(self, param, effect_up, effect_down=None):
         raise NotImplementedError
@@ -84,6 +114,9 @@ class Sample(object):
     def getExpectation(self, nominal=False):
         raise NotImplementedError
 
+    def rebin(self, observable):
+        raise NotImplementedError
+
     def renderRoofit(self, workspace):
         raise NotImplementedError
 
@@ -93,8 +126,19 @@ class Sample(object):
     def combineParamEffect(self, param):
         raise NotImplementedError
 
+    def combineParamEffects(self, params):
+        '''
+        A list of formatted strings for placement into the combine datacard, one for each of params
+        (see combineParamEffect)
+        '''
+        return [self.combineParamEffect(param) for param in params]
+
 
 class TemplateSample(Sample):
+    # If True, renderRoofit embeds the shape systematics in the sample pdf, as a PiecewiseInterpolation
+    # vertical morphing of the templates, and the datacard declares them as 'param' rather than 'shape'
+    RenderMorphing = False
+
     def __init__(self, name, sampletype, template):
         '''
         name: self-explanatory
@@ -118,6 +162,7 @@ class TemplateSample(Sample):
         self._paramEffectsDown = {}
         self._paramEffectScales = {}
         self._extra_dependencies = set()
+        self._autoMCStatsParams = set()
 
     def show(self):
         print(self._nominal)
@@ -128,15 +173,27 @@ class TemplateSample(Sample):
         self._nominal *= _scale
         if self._sumw2 is not None:
             self._sumw2 *= _scale*_scale
+        self._modified()
+
+    @property
+    def sumw2(self):
+        '''
+        The sum of squared weights of the template, or None if it was not provided
+        Bins that are masked are set to 0.
+        '''
+        if self._sumw2 is None:
+            return None
+        sumw2 = self._sumw2.copy()
+        if self.mask is not None:
+            sumw2[~self.mask] = 0.
+        return sumw2
 
     @property
     def parameters(self):
         '''
         Set of independent parameters that affect this sample
         '''
-        pset = set(self._paramEffectsUp.keys())
-        pset.update(self._extra_dependencies)
-        return pset
+        return self._cached('parameters', lambda: frozenset(self._paramEffectsUp.keys()) | self._extra_dependencies)
 
     def setParamEffect(self, param, effect_up, effect_down=None, scale=None):
         '''
@@ -153,6 +210,7 @@ class TemplateSample(Sample):
 
         N.B. the parameter must have a compatible combinePrior, i.e. if param.combinePrior is 'shape', then one must pass a numpy array
         '''
+        self._modified()
         if not isinstance(param, NuisanceParameter):
             if isinstance(param, IndependentParameter) and isinstance(effect_up, DependentParameter):
                 extras = effect_up.getDependents() - {param}
@@ -223,6 +281,61 @@ class TemplateSample(Sample):
         elif scale is not None:
             raise ValueError("Cannot understand scale value %r. It should be a number" % scale)
 
+    def setParamEffects(self, params, effects_up, effects_down=None, scales=None):
+        '''
+        Set the effect of many nuisance parameters on a sample at once
+        params: a sequence of N NuisanceParameter objects
+        effects_up: a (N, nbins) array of relative (multiplicative) effects of each parameter on the bin yields,
+                    or a length-N array of relative effects on the sample normalization
+        effects_down: if asymmetric effects, an array of the same shape as effects_up, otherwise the effects_up values will be symmetrized
+        scales: a number or length-N array, ad-hoc rescaling of the effects (see setParamEffect)
+
+        The effects are validated together and stored as rows of a single contiguous matrix.
+        As in setParamEffect, effects that do not change the sample are dropped.
+        '''
+        self._modified()
+        params = list(params)
+        if not all(isinstance(p, NuisanceParameter) for p in params):
+            raise ValueError("Bulk effects can only be set for NuisanceParameter objects")
+        shape = (len(params), self.observable.nbins)
+
+        def _effect_matrix(effects, label):
+            effects = np.array(effects, dtype=float)
+            if effects.shape == shape[:1]:
+                return effects, np.repeat(effects[:, None], shape[1], axis=1)
+            elif effects.shape != shape:
+                raise ValueError("%s has the wrong shape (%r, expected %r)" % (label, effects.shape, shape))
+            return None, effects
+
+        norm_up, effects_up = _effect_matrix(effects_up, 'effects_up')
+        norm_down = None
+        if effects_down is not None:
+            norm_down, effects_down = _effect_matrix(effects_down, 'effects_down')
+        if scales is not None:
+            scales = np.broadcast_to(np.asarray(scales, dtype=float), shape[:1])
+
+        # effects without impact on the sample are dropped, as in setParamEffect
+        keep = (effects_up.dot(self._nominal) != 0) & ~np.all(effects_up == 1., axis=1)
+        effects_up = effects_up[keep]
+        if effects_down is not None:
+            effects_down = effects_down[keep]
+        for i, iparam in enumerate(np.flatnonzero(keep)):
+            param = params[iparam]
+            # normalization effects are kept scalar, as in setParamEffect
+            scalar = 'shape' not in param.combinePrior
+            if scalar and norm_up is not None:
+                self._paramEffectsUp[param] = float(norm_up[iparam])
+            else:
+                self._paramEffectsUp[param] = effects_up[i]
+            if effects_down is None:
+                self._paramEffectsDown[param] = None
+            elif scalar and norm_down is not None:
+                self._paramEffectsDown[param] = float(norm_down[iparam])
+            else:
+                self._paramEffectsDown[param] = effects_down[i]
+            if scales is not None:
+                self._paramEffectScales[param] = float(scales[iparam])
+
     def getParamEffect(self, param, up=True):
         '''
         Get the parameter effect
@@ -235,6 +348,61 @@ class TemplateSample(Sample):
                 return 1. / self._paramEffectsUp[param]
             return self._paramEffectsDown[param]
 
+    def removeParamEffect(self, param):
+        '''
+        Remove the effect of a nuisance parameter from the sample
+        '''
+        if not isinstance(param, NuisanceParameter):
+            raise ValueError("Only NuisanceParameter effects can be removed, got %r" % param)
+        if param not in self._paramEffectsUp:
+            raise KeyError("Sample %r has no effect for parameter %r" % (self, param))
+        del self._paramEffectsUp[param]
+        self._paramEffectsDown.pop(param, None)
+        self._paramEffectScales.pop(param, None)
+        self._autoMCStatsParams.discard(param)
+        self._modified()
+
+    def pruneEffects(self, norm_threshold, shape_threshold):
+        '''
+        Remove negligible nuisance parameter effects from the sample
+            norm_threshold: normalization effects (i.e. non-shape priors) are removed if the relative change
+                in the sample normalization is below this value for both up and down variations
+            shape_threshold: shape effects are removed if the largest change in any bin yield, relative to the
+                total sample yield, is below this value for both up and down variations
+        Effects handled by autoMCStats and normalization modifiers (DependentParameter effects) are never removed.
+        Returns the list of parameters whose effect was removed.
+        '''
+        nominal = self.getExpectation(nominal=True)
+        total = nominal.sum()
+        pruned = []
+        for param in list(self._paramEffectsUp.keys()):
+            effect_up = self._paramEffectsUp[param]
+            if not isinstance(param, NuisanceParameter) or param in self._autoMCStatsParams:
+                continue
+            elif effect_up is None or isinstance(effect_up, DependentParameter):
+                continue
+            scale = self._paramEffectScales.get(param, 1.)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                up = (effect_up - 1) * scale
+                down = (self.getParamEffect(param, up=False) - 1) * scale
+                if 'shape' in param.combinePrior:
+                    if total <= 0.:
+                        size = 0.
+                    else:
+                        size = max(np.max(np.abs(up * nominal)), np.max(np.abs(down * nominal))) / total
+                    threshold = shape_threshold
+                else:
+                    if isinstance(up, np.ndarray):
+                        # shape to norm conversion, as in the datacard
+                        up = 0. if total <= 0. else (up * nominal).sum() / total
+                        down = 0. if total <= 0. else (down * nominal).sum() / total
+                    size = max(abs(up), abs(down))
+                    threshold = norm_threshold
+            if size < threshold:
+                self.removeParamEffect(param)
+                pruned.append(param)
+        return pruned
+
     def autoMCStats(self):
         '''                                                                                                                              Set MC statical uncertainties based on self._sumw2
         '''
@@ -253,54 +421,100 @@ class TemplateSample(Sample):
             param = NuisanceParameter(self.name + '_mcstat_bin%i' % i, combinePrior='shape')
             self.setParamEffect(param, effect_up, effect_down)
 
+    def setAutoMCStatsEffect(self, param, effect_up, effect_down):
+        '''
+        Set a per-bin MC statistical effect that is managed by the channel (see Channel.autoMCStats)
+        It enters the expectation like any other shape effect, but no templates or datacard entries
+        are made for it, as combine builds the equivalent parameters from the autoMCStats datacard line.
+        '''
+        self.setParamEffect(param, effect_up, effect_down)
+        if param in self._paramEffectsUp:
+            self._autoMCStatsParams.add(param)
+
     def getExpectation(self, nominal=False):
         '''
         Create an array of per-bin expectations, accounting for all nuisance parameter effects
             nominal: if True, calculate the nominal expectation (i.e. just plain numbers)
+        The (non-nominal) expectation is cached until the sample is modified, hence it is read-only
         '''
-        nominalval = self._nominal.copy()
-        if self.mask is not None:
-            nominalval[~self.mask] = 0.
         if nominal:
+            nominalval = self._nominal.copy()
+            if self.mask is not None:
+                nominalval[~self.mask] = 0.
             return nominalval
-        else:
-            out = np.array([IndependentParameter(self.name + "_bin%d_nominal" % i, v, constant=True) for i, v in enumerate(nominalval)])
-            for param in self.parameters:
-                effect_up = self.getParamEffect(param, up=True)
-                if effect_up is None:
-                    continue
-                if param in self._paramEffectScales:
-                    param_scaled = param * self._paramEffectScales[param]
+        return self._cached('expectation', self._buildExpectation)
+
+    def _buildExpectation(self):
+        nominalval = self.getExpectation(nominal=True)
+        out = np.array([IndependentParameter(self.name + "_bin%d_nominal" % i, v, constant=True) for i, v in enumerate(nominalval)])
+        for param in self.parameters:
+            effect_up = self.getParamEffect(param, up=True)
+            if effect_up is None:
+                continue
+            if param in self._paramEffectScales:
+                param_scaled = param * self._paramEffectScales[param]
+            else:
+                param_scaled = param
+            if isinstance(effect_up, DependentParameter):
+                out = out * effect_up
+            elif self._paramEffectsDown[param] is None:
+                if param.combinePrior == 'shape':
+                    out = out * (1 + (effect_up - 1)*param_scaled)
+                elif param.combinePrior == 'shapeN':
+                    out = out * (effect_up**param_scaled)
+                elif param.combinePrior == 'lnN':
+                    # TODO: ensure scalar effect
+                    out = out * (effect_up**param_scaled)
                 else:
-                    param_scaled = param
-                if isinstance(effect_up, DependentParameter):
-                    out = out * effect_up
-                elif self._paramEffectsDown[param] is None:
-                    if param.combinePrior == 'shape':
-                        out = out * (1 + (effect_up - 1)*param_scaled)
-                    elif param.combinePrior == 'shapeN':
-                        out = out * (effect_up**param_scaled)
-                    elif param.combinePrior == 'lnN':
-                        # TODO: ensure scalar effect
-                        out = out * (effect_up**param_scaled)
-                    else:
-                        raise NotImplementedError('per-bin effects for other nuisance parameter types')
+                    raise NotImplementedError('per-bin effects for other nuisance parameter types')
+            else:
+                effect_down = self.getParamEffect(param, up=False)
+                smoothStep = SmoothStep(param_scaled)
+                if param.combinePrior == 'shape':
+                    combined_effect = smoothStep * (1 + (effect_up - 1)*param_scaled) + (1 - smoothStep) * (1 - (effect_down - 1)*param_scaled)
+                elif param.combinePrior == 'shapeN':
+                    combined_effect = smoothStep * (effect_up**param_scaled) + (1 - smoothStep) / (effect_down**param_scaled)
+                elif param.combinePrior == 'lnN':
+                    # TODO: ensure scalar effect
+                    combined_effect = smoothStep * (effect_up**param_scaled) + (1 - smoothStep) / (effect_down**param_scaled)
                 else:
-                    effect_down = self.getParamEffect(param, up=False)
-                    smoothStep = SmoothStep(param_scaled)
-                    if param.combinePrior == 'shape':
-                        combined_effect = smoothStep * (1 + (effect_up - 1)*param_scaled) + (1 - smoothStep) * (1 - (effect_down - 1)*param_scaled)
-                    elif param.combinePrior == 'shapeN':
-                        combined_effect = smoothStep * (effect_up**param_scaled) + (1 - smoothStep) / (effect_down**param_scaled)
-                    elif param.combinePrior == 'lnN':
-                        # TODO: ensure scalar effect
-                        combined_effect = smoothStep * (effect_up**param_scaled) + (1 - smoothStep) / (effect_down**param_scaled)
-                    else:
-                        raise NotImplementedError('per-bin effects for other nuisance parameter types')
-                    out = out * combined_effect
+                    raise NotImplementedError('per-bin effects for other nuisance parameter types')
+                out = out * combined_effect
 
-            return out
+        out.setflags(write=False)
+        return out
 
+    def rebin(self, observable):
+        '''
+        Merge bins of the sample into the binning of observable, whose edges must be a subset of the current ones
+        The nominal template and sumw2 are summed, and relative effects are converted to absolute yields,
+        summed, and converted back to relative.  Masked bins are zeroed before merging, and the mask is reset,
+        so one should apply a (merged) mask again afterwards.  This is done automatically by Channel.rebin
+        '''
+        starts = _merge_indices(self.observable.binning, observable.binning)
+        nominal = self.getExpectation(nominal=True)
+        new_nominal = np.add.reduceat(nominal, starts)
+        nonzero = new_nominal > 0.
+
+        def _merge_effect(effect):
+            if not isinstance(effect, np.ndarray):
+                return effect
+            merged = np.ones_like(new_nominal)
+            merged[nonzero] = np.add.reduceat(effect * nominal, starts)[nonzero] / new_nominal[nonzero]
+            return merged
+
+        for param in self._paramEffectsUp:
+            self._paramEffectsUp[param] = _merge_effect(self._paramEffectsUp[param])
+            if self._paramEffectsDown.get(param, None) is not None:
+                self._paramEffectsDown[param] = _merge_effect(self._paramEffectsDown[param])
+        if self._sumw2 is not None:
+            self._sumw2 = np.add.reduceat(self.sumw2, starts)
+        self._nominal = new_nominal
+        self._observable = observable
+        self._mask = None
+        self._modified()
+
+    @_render_once
     def renderRoofit(self, workspace):
         '''
         Import the necessary Roofit objects into the workspace for this sample
@@ -314,36 +528,125 @@ class TemplateSample(Sample):
         if rooShape == None and rooNorm == None:  # noqa: E711
             rooObservable = self.observable.renderRoofit(workspace)
             nominal = self.getExpectation(nominal=True)
-            rooTemplate = ROOT.RooDataHist(self.name, self.name, ROOT.RooArgList(rooObservable), _to_TH1(nominal, self.observable.binning, self.observable.name))
+            # the sumw2 is used by combine for autoMCStats
+            template = nominal if self._sumw2 is None else (nominal, self.sumw2)
+            rooTemplate = ROOT.RooDataHist(self.name, self.name, ROOT.RooArgList(rooObservable), _to_TH1(template, self.observable.binning, self.observable.name))
             workspace.add(rooTemplate)
-            for param in self.parameters:
-                effect_up = self.getParamEffect(param, up=True)
-                if 'shape' not in param.combinePrior:
-                    # Normalization systematics can just go into combine datacards (although if we build PDF here, will need it)
-                    if isinstance(effect_up, DependentParameter):
-                        # this is a rateParam, we should add the IndependentParameter to the workspace
-                        param.renderRoofit(workspace)
-                    continue
-                name = self.name + '_' + param.name + 'Up'
-                shape = nominal * effect_up
-                rooTemplate = ROOT.RooDataHist(name, name, ROOT.RooArgList(rooObservable), _to_TH1(shape, self.observable.binning, self.observable.name))
-                workspace.add(rooTemplate)
-                name = self.name + '_' + param.name + 'Down'
-                shape = nominal * self.getParamEffect(param, up=False)
-                rooTemplate = ROOT.RooDataHist(name, name, ROOT.RooArgList(rooObservable), _to_TH1(shape, self.observable.binning, self.observable.name))
-                workspace.add(rooTemplate)
-
-            rooShape = ROOT.RooHistPdf(self.name, self.name, ROOT.RooArgSet(rooObservable), workspace.data(self.name))
-            workspace.add(rooShape)
-            rooNorm = IndependentParameter(normName, nominal.sum(), constant=True).renderRoofit(workspace)
-            # TODO build the pdf with systematics
+            if self.RenderMorphing:
+                self._renderMorphing(workspace, rooObservable, nominal)
+            else:
+                for param in self.parameters:
+                    if param in self._autoMCStatsParams:
+                        continue
+                    effect_up = self.getParamEffect(param, up=True)
+                    if 'shape' not in param.combinePrior:
+                        # Normalization systematics can just go into combine datacards (although if we build PDF here, will need it)
+                        if isinstance(effect_up, DependentParameter):
+                            # this is a rateParam, we should add the IndependentParameter to the workspace
+                            param.renderRoofit(workspace)
+                        continue
+                    name = self.name + '_' + param.name + 'Up'
+                    shape = nominal * effect_up
+                    rooTemplate = ROOT.RooDataHist(name, name, ROOT.RooArgList(rooObservable), _to_TH1(shape, self.observable.binning, self.observable.name))
+                    workspace.add(rooTemplate)
+                    name = self.name + '_' + param.name + 'Down'
+                    shape = nominal * self.getParamEffect(param, up=False)
+                    rooTemplate = ROOT.RooDataHist(name, name, ROOT.RooArgList(rooObservable), _to_TH1(shape, self.observable.binning, self.observable.name))
+                    workspace.add(rooTemplate)
+
+                rooShape = ROOT.RooHistPdf(self.name, self.name, ROOT.RooArgSet(rooObservable), workspace.data(self.name))
+                workspace.add(rooShape)
+                rooNorm = IndependentParameter(normName, nominal.sum(), constant=True).renderRoofit(workspace)
         elif rooShape == None or rooNorm == None:  # noqa: E711
             raise RuntimeError('Sample %r has either a shape or norm already embedded in workspace %r' % (self, workspace))
         rooShape = workspace.pdf(self.name)
         rooNorm = workspace.function(self.name + '_norm')
         return rooShape, rooNorm
 
+    def _renderMorphing(self, workspace, rooObservable, nominal):
+        '''
+        Add the pdf and norm for this sample, with all shape systematics embedded through
+        one vertical morphing function of the templates (see RenderMorphing)
+        '''
+        import ROOT
+        binning = self.observable.binning
+        binw = np.diff(binning)
+
+        def histFunc(name, values):
+            # RooHistFunc does not correct for the bin width, so we morph densities
+            rooData = ROOT.RooDataHist(name, name, ROOT.RooArgList(rooObservable), _to_TH1(values / binw, binning, self.observable.name))
+            workspace.add(rooData)
+            rooFunc = ROOT.RooHistFunc(name + '_func', name + '_func', ROOT.RooArgSet(rooObservable), workspace.data(name))
+            workspace.add(rooFunc, recycle=True)
+            return workspace.function(name + '_func')
+
+        total = nominal.sum()
+        rooParams, lows, highs, normLows, normHighs, codes = [], [], [], [], [], []
+        for param in sorted(self.parameters, key=lambda p: p.name):
+            if param in self._autoMCStatsParams:
+                continue
+            effect_up = self.getParamEffect(param, up=True)
+            if isinstance(effect_up, DependentParameter):
+                # this is a rateParam, we should add the IndependentParameter to the workspace
+                param.renderRoofit(workspace)
+                continue
+            elif 'shape' not in param.combinePrior:
+                # normalization systematics still go into combine datacards
+                continue
+            scale = self._paramEffectScales.get(param, 1.)
+            effect_down = self.getParamEffect(param, up=False)
+            # the templates at +-1 sigma, with the scale applied as in getExpectation
+            if param.combinePrior == 'shapeN':
+                up = nominal * effect_up**scale
+                down = nominal * effect_down**scale
+            else:
+                up = nominal * ((effect_up - 1) * scale + 1)
+                down = nominal * ((effect_down - 1) * scale + 1)
+            rooParams.append(param.renderRoofit(workspace))
+            highs.append(histFunc(self.name + '_' + param.name + 'Up_morph', up))
+            lows.append(histFunc(self.name + '_' + param.name + 'Down_morph', down))
+            # PiecewiseInterpolation takes the variations as absolute values, like the nominal
+            normHighs.append(ROOT.RooConstVar(self.name + '_' + param.name + 'Up_norm', '', up.sum()))
+            normLows.append(ROOT.RooConstVar(self.name + '_' + param.name + 'Down_norm', '', down.sum()))
+            # polynomial interpolation and linear extrapolation as for combine shape morphing, exponential for shapeN
+            codes.append(1 if param.combinePrior == 'shapeN' else 4)
+
+        morph = ROOT.PiecewiseInterpolation(self.name + '_morph', self.name + '_morph',
+                                            histFunc(self.name + '_nominal_morph', nominal),
+                                            ROOT.RooArgList.fromiter(lows),
+                                            ROOT.RooArgList.fromiter(highs),
+                                            ROOT.RooArgList.fromiter(rooParams),
+                                            )
+        morph.setPositiveDefinite(True)
+        for rooParam, code in zip(rooParams, codes):
+            morph.setInterpCode(rooParam, code)
+        workspace.add(morph, recycle=True)
+        # PyROOT would delete temporaries before the workspace imports their users, so keep them in locals
+        rooCoef = ROOT.RooConstVar(self.name + '_morph_coef', '', 1.)
+        rooShape = ROOT.RooRealSumPdf(self.name, self.name,
+                                      ROOT.RooArgList(workspace.function(self.name + '_morph')),
+                                      ROOT.RooArgList(rooCoef),
+                                      False,
+                                      )
+        workspace.add(rooShape, recycle=True)
+        # the normalization effect of the shape systematics, as asymmetric log-normal
+        rooNominalNorm = ROOT.RooConstVar(self.name + '_nominal_norm', '', total)
+        if total <= 0:
+            # no variation of an empty template, and the log-normal interpolation is undefined
+            normLows, normHighs, rooParams = [], [], []
+        rooNorm = ROOT.PiecewiseInterpolation(self.name + '_norm', self.name + '_norm',
+                                              rooNominalNorm,
+                                              ROOT.RooArgList.fromiter(normLows),
+                                              ROOT.RooArgList.fromiter(normHighs),
+                                              ROOT.RooArgList.fromiter(rooParams),
+                                              )
+        rooNorm.setAllInterpCodes(1)
+        workspace.add(rooNorm, recycle=True)
+
     def combineNormalization(self):
+        if self.RenderMorphing:
+            # combine scales the pdf by the rendered _norm function, which includes the nominal yield
+            return 1.
         return self.getExpectation(nominal=True).sum()
 
     def combineParamEffect(self, param):
@@ -351,9 +654,12 @@ class TemplateSample(Sample):
         A formatted string for placement into the combine datacard that represents
         the effect of a parameter on a sample (e.g. the size of unc. or multiplier for shape unc.)
         '''
-        if self._paramEffectsUp.get(param, None) is None:
+        if self._paramEffectsUp.get(param, None) is None or param in self._autoMCStatsParams:
             return '-'
         elif 'shape' in param.combinePrior:
+            if self.RenderMorphing:
+                # the shape effect is embedded in the sample pdf
+                return '-'
             return '%.3f' % self._paramEffectScales.get(param, 1)
         elif isinstance(self.getParamEffect(param, up=True), DependentParameter):
             # about here's where I start to feel painted into a corner
@@ -389,37 +695,95 @@ class TemplateSample(Sample):
             else:
                 return '%.3f/%.3f' % (up, down)
 
+    def combineParamEffects(self, params):
+        '''
+        A list of formatted strings for placement into the combine datacard, one for each of params
+        Same as combineParamEffect, but the shape to normalization conversions are computed all at once
+        '''
+        out = ['-'] * len(params)
+        shapes = []
+        for i, param in enumerate(params):
+            effect_up = self._paramEffectsUp.get(param, None)
+            if effect_up is None or param in self._autoMCStatsParams:
+                continue
+            elif 'shape' in param.combinePrior:
+                out[i] = '-' if self.RenderMorphing else '%.3f' % self._paramEffectScales.get(param, 1)
+            elif isinstance(effect_up, DependentParameter):
+                out[i] = self.combineParamEffect(param)
+            elif isinstance(effect_up, np.ndarray):
+                shapes.append(i)
+            else:
+                out[i] = self.combineParamEffect(param)
+
+        if len(shapes) > 0:
+            # TODO the scaling here depends on the prior of the nuisance parameter
+            scales = np.array([self._paramEffectScales.get(params[i], 1.) for i in shapes])[:, None]
+            # the down effect may be a number, e.g. a per-bin lnN effect with a flat down variation
+            shape = (len(shapes), self.observable.nbins)
+            up = np.empty(shape)
+            down = np.empty(shape)
+            for j, i in enumerate(shapes):
+                up[j] = self.getParamEffect(params[i], up=True)
+                down[j] = self.getParamEffect(params[i], up=False)
+            up = (up - 1) * scales + 1
+            down = (down - 1) * scales + 1
+            # Convert shape to norm (note symmeterized effect on shape != symmeterized effect on norm)
+            nominal = self.getExpectation(nominal=True)
+            if nominal.sum() == 0:
+                for i in shapes:
+                    out[i] = '%.3f' % 1.
+            else:
+                up = up.dot(nominal) / nominal.sum()
+                down = down.dot(nominal) / nominal.sum()
+                for i, u, d in zip(shapes, up, down):
+                    out[i] = '%.3f/%.3f' % (u, d)
+        return out
+
 
 class ParametericSample(Sample):
     PreferRooParametricHist = True
+    # The expectation of all masked bins, so that they are rendered as a single constant
+    MaskedBin = IndependentParameter('rhalphalib_masked_bin', 0, constant=True)
 
     def __init__(self, name, sampletype, observable, params):
         '''
         Create a sample that is a binned function, where each bin yield
         is given by the param in params.  The list params should have the
         same number of bins as observable.
+        Subclasses that build the parameters on demand (by overriding _nominalParams) pass params=None.
         '''
         super(ParametericSample, self).__init__(name, sampletype)
         if not isinstance(observable, Observable):
             raise ValueError
+        self._observable = observable
+        self._nominal = None
+        self._paramEffectsUp = {}
+        self._paramEffectsDown = {}
+        if params is None:
+            if type(self)._nominalParams is ParametericSample._nominalParams:
+                raise ValueError("ParametericSample expects parameters")
+            return
         if len(params) != observable.nbins:
             raise ValueError
-        self._observable = observable
         self._nominal = np.array(params)
         if not all(isinstance(p, Parameter) for p in self._nominal):
             raise ValueError("ParametericSample expects parameters to derive from Parameter type.")
-        self._paramEffectsUp = {}
-        self._paramEffectsDown = {}
 
     @property
     def parameters(self):
         '''
         Set of independent parameters that affect this sample
         '''
-        pset = set()
-        for p in self.getExpectation():
-            pset.update(p.getDependents(deep=True))
-        return pset
+        def _build():
+            pset = set()
+            for p in self._liveExpectation():
+                pset.update(p.getDependents(deep=True))
+            # a live bin can depend on a masked bin of another sample (e.g. a TransferFactorSample), but the
+            # shared MaskedBin constant is not a parameter of any model
+            pset.discard(self.MaskedBin)
+            return frozenset(pset)
+
+        return self._cached('parameters', _build)
 
     def setParamEffect(self, param, effect_up, effect_down=None):
         '''
@@ -431,6 +795,7 @@ class ParametericSample(Sample):
 
         N.B. the parameter must have a compatible combinePrior, i.e. if param.combinePrior is 'shape', then one must pass a numpy array
         '''
+        self._modified()
         if not isinstance(param, NuisanceParameter):
             raise ValueError("Template morphing can only be done via a NuisanceParameter")
 
@@ -473,33 +838,92 @@ class ParametericSample(Sample):
         '''
         Create an array of per-bin expectations, accounting for all nuisance parameter effects
             nominal: if True, calculate the nominal expectation (i.e. just plain numbers)
+        The (non-nominal) expectation is cached until the sample is modified, hence it is read-only
+        Masked bins are excluded from the expression graph: their expectation is the shared MaskedBin constant.
         '''
-        out = self._nominal.copy()  # this is a shallow copy
-        if self.mask is not None:
-            out[~self.mask] = [IndependentParameter("masked", 0, constant=True) for _ in range((~self.mask).sum())]
         if nominal:
-            return np.array([p.value for p in out])
-        else:
-            for param in self._paramEffectsUp.keys():
-                effect_up = self.getParamEffect(param, up=True)
-                if effect_up is None:
-                    pass
-                if self._paramEffectsDown[param] is None:
-                    out = out * (effect_up**param)
-                else:
-                    effect_down = self.getParamEffect(param, up=False)
-                    smoothStep = SmoothStep(param)
-                    combined_effect = smoothStep * (effect_up**param) + (1 - smoothStep) * (effect_down**param)
-                    out = out * combined_effect
+            out = np.zeros(self.observable.nbins)
+            live = self._liveBins()
+            out[live] = [p.value for p in self._nominalParams()[live]]
+            return out
+        return self._cached('expectation', self._buildExpectation)
 
-            for i, p in enumerate(out):
-                p.name = self.name + '_bin%d' % i
-                if isinstance(p, DependentParameter):
-                    # Let's make sure to render these
-                    p.intermediate = False
+    def _nominalParams(self):
+        '''
+        The per-bin parameters before any parameter effects are applied
+        '''
+        return self._nominal
 
-            return out
+    def _liveBins(self):
+        if self.mask is None:
+            return np.ones(self.observable.nbins, dtype=bool)
+        return self.mask
+
+    def _liveExpectation(self):
+        '''
+        The expectation of the unmasked bins only
+        '''
+        return self.getExpectation()[self._liveBins()]
+
+    def _buildExpectation(self):
+        live = self._liveBins()
+        out = self._nominalParams()[live]
+        for param in self._paramEffectsUp.keys():
+            effect_up = self.getParamEffect(param, up=True)
+            if isinstance(effect_up, np.ndarray):
+                effect_up = effect_up[live]
+            if self._paramEffectsDown[param] is None:
+                out = out * (effect_up**param)
+            else:
+                effect_down = self.getParamEffect(param, up=False)
+                if isinstance(effect_down, np.ndarray):
+                    effect_down = effect_down[live]
+                smoothStep = SmoothStep(param)
+                combined_effect = smoothStep * (effect_up**param) + (1 - smoothStep) * (effect_down**param)
+                out = out * combined_effect
+
+        for i, p in zip(np.flatnonzero(live), out):
+            p.name = self.name + '_bin%d' % i
+            if isinstance(p, DependentParameter):
+                # Let's make sure to render these
+                p.intermediate = False
+
+        expectation = np.array([self.MaskedBin] * self.observable.nbins)
+        expectation[live] = out
+        expectation.setflags(write=False)
+        return expectation
+
+    def rebin(self, observable):
+        '''
+        Merge bins of the sample into the binning of observable, whose edges must be a subset of the current ones
+        Each new bin is the sum of the expectation (i.e. including all effects) of the bins it contains,
+        hence the parameter effects are absorbed into the new bin parameters.  Masked bins are excluded from
+        the sums, and the mask is reset, so one should apply a (merged) mask again afterwards.
+        This is done automatically by Channel.rebin
+        '''
+        starts = _merge_indices(self.observable.binning, observable.binning)
+        stops = np.append(starts[1:], self.observable.nbins)
+        params = self.getExpectation()
+        merged = []
+        for start, stop in zip(starts, stops):
+            group = [i for i in range(start, stop) if self.mask is None or self.mask[i]]
+            if len(group) == 0:
+                # this bin will be masked
+                merged.append(IndependentParameter(self.name + '_bin%d' % len(merged), 0, constant=True))
+                continue
+            if len(group) > 1:
+                for i in group:
+                    # old bin names would clash with the new ones
+                    params[i].name = self.name + '_bin%dof%d' % (i, self.observable.nbins)
+            merged.append(_pairwise_sum(params[group]))
+        self._nominal = np.array(merged)
+        self._paramEffectsUp = {}
+        self._paramEffectsDown = {}
+        self._observable = observable
+        self._mask = None
+        self._modified()
 
+    @_render_once
     def renderRoofit(self, workspace):
         '''
         Produce a RooParametricHist (if available) or RooParametricStepFunction and add to workspace
@@ -513,13 +937,14 @@ class ParametericSample(Sample):
         if rooShape == None and rooNorm == None:  # noqa: E711
             rooObservable = self.observable.renderRoofit(workspace)
             params = self.getExpectation()
+            live = self._liveBins()
 
             if hasattr(ROOT, 'RooParametricHist') and self.PreferRooParametricHist:
-                rooParams = [p.renderRoofit(workspace) for p in params]
+                rooParams = np.array([p.renderRoofit(workspace) for p in params])
                 # need a dummy hist to generate proper binning
                 dummyHist = _to_TH1(np.zeros(self.observable.nbins), self.observable.binning, self.observable.name)
                 rooShape = ROOT.RooParametricHist(self.name, self.name, rooObservable, ROOT.RooArgList.fromiter(rooParams), dummyHist)
-                rooNorm = ROOT.RooAddition(self.name + '_norm', self.name + '_norm', ROOT.RooArgList.fromiter(rooParams))
+                rooNorm = ROOT.RooAddition(self.name + '_norm', self.name + '_norm', ROOT.RooArgList.fromiter(rooParams[live]))
                 workspace.add(rooShape)
                 workspace.add(rooNorm)
             else:
@@ -528,27 +953,27 @@ class ParametericSample(Sample):
                                   "Set ParametericSample.PreferRooParametricHist = False to disable this warning",
                                   RuntimeWarning)
                 # RooParametricStepFunction expects parameters to represent PDF density (i.e. bin width normalized, and integrates to 1)
-                norm = _pairwise_sum(params)
-                norm.name = self.name + '_norm'
-                norm.intermediate = False
+                # The normalization is rendered once as a sum, which each density references rather than inlining it
+                rooParams = np.array([p.renderRoofit(workspace) for p in params])
+                rooNorm = ROOT.RooAddition(self.name + '_norm', self.name + '_norm', ROOT.RooArgList.fromiter(rooParams[live]))
+                workspace.add(rooNorm)
+                rooNorm = workspace.function(self.name + '_norm')
 
                 binw = np.diff(self.observable.binning)
-                dparams = params / binw / norm
-
-                for p, oldp in zip(dparams, params):
-                    p.name = oldp.name + "_density"
-                    p.intermediate = False
-
                 # The last bin value is defined by 1 - sum(others), so no need to render it
-                rooParams = [p.renderRoofit(workspace) for p in dparams[:-1]]
+                for i in np.flatnonzero(live[:-1]):
+                    name = params[i].name + "_density"
+                    density = ROOT.RooFormulaVar(name, name, "@0/(%r*@1)" % float(binw[i]), ROOT.RooArgList(rooParams[i], rooNorm))
+                    workspace.add(density)
+                    rooParams[i] = workspace.function(name)
+
                 rooShape = ROOT.RooParametricStepFunction(self.name, self.name,
                                                           rooObservable,
-                                                          ROOT.RooArgList.fromiter(rooParams),
+                                                          ROOT.RooArgList.fromiter(rooParams[:-1]),
                                                           self.observable.binningTArrayD(),
                                                           self.observable.nbins
                                                           )
                 workspace.add(rooShape)
-                rooNorm = norm.renderRoofit(workspace)  # already rendered but we want to return it
         elif rooShape == None or rooNorm == None:  # noqa: E711
             raise RuntimeError('Channel %r has either a shape or norm already embedded in workspace %r' % (self, workspace))
         rooShape = workspace.pdf(self.name)
@@ -579,24 +1004,96 @@ class TransferFactorSample(ParametericSample):
         dimension matches the sample binning, i.e. expectation = tf @ dependent_expectation.
         The latter requires an additional observable argument to specify the definition of the first dimension.
         In all cases, please use numpy object arrays of Parameter types.
+        A matrix may also be sparse: a scipy.sparse matrix of numbers, or an object array where None
+        and zero entries are skipped rather than generating terms.
+        The product is built on first use, and rebuilt whenever the dependent sample is modified.
         '''
-        if not isinstance(transferfactor, np.ndarray):
+        if not (isinstance(transferfactor, np.ndarray) or scipy.sparse.issparse(transferfactor)):
             raise ValueError("Transfer factor is not a numpy array")
         if not isinstance(dependentsample, Sample):
             raise ValueError("Dependent sample does not inherit from Sample")
         if len(transferfactor.shape) == 2:
             if observable is None:
                 raise ValueError("Transfer factor is 2D array, please provide an observable")
-            params = np.dot(transferfactor, dependentsample.getExpectation())
-        elif len(transferfactor.shape) <= 1:
+            if transferfactor.shape != (observable.nbins, dependentsample.observable.nbins):
+                raise ValueError("Transfer factor shape %r does not match the observable and dependent sample binning" % (transferfactor.shape, ))
+        elif len(transferfactor.shape) <= 1 and not scipy.sparse.issparse(transferfactor):
             observable = dependentsample.observable
-            params = transferfactor * dependentsample.getExpectation()
+            if len(transferfactor.shape) == 1 and len(transferfactor) != observable.nbins:
+                raise ValueError("Transfer factor has the wrong number of bins (%d, expected %d)" % (len(transferfactor), observable.nbins))
         else:
             raise ValueError("Transfer factor has invalid dimension")
-        super(TransferFactorSample, self).__init__(name, sampletype, observable, params)
+        super(TransferFactorSample, self).__init__(name, sampletype, observable, None)
         self._transferfactor = transferfactor
         self._dependentsample = dependentsample
 
+    @property
+    def version(self):
+        '''
+        As for Sample, but also increasing whenever the dependent sample is modified
+        '''
+        return self._version + self._dependentsample.version
+
+    def _nominalParams(self):
+        if self._nominal is not None:
+            # after a rebin, the product is fixed
+            return self._nominal
+        return self._cached('nominal', self._buildProduct)
+
+    @property
+    def lazy(self):
+        '''
+        True while the product is rebuilt whenever the dependent sample is modified, i.e. until fixProduct is called
+        '''
+        return self._nominal is None
+
+    def fixProduct(self):
+        '''
+        Build the product of the transfer factor and the dependent sample once and for all, so that it no longer
+        follows the dependent sample, e.g. before the dependent sample is rebinned (see Model.rebin)
+        '''
+        if self._nominal is None:
+            self._nominal = self._nominalParams()
+            self._modified()
+
+    def _buildProduct(self):
+        dependent = self._dependentsample.getExpectation()
+        tf = self._transferfactor
+        if tf.shape[-1:] not in [(), (len(dependent), )]:
+            raise RuntimeError(
+                "Transfer factor of %r has %d bins, but the dependent sample %r now has %d. "
+                "Channels related by a transfer factor should be rebinned together, with Model.rebin"
+                % (self, tf.shape[-1], self._dependentsample, len(dependent))
+            )
+        if len(tf.shape) <= 1:
+            params = tf * dependent
+        else:
+            if scipy.sparse.issparse(tf):
+                tf = tf.tocsr()
+                rows = [zip(tf.indices[start:stop], tf.data[start:stop]) for start, stop in zip(tf.indptr[:-1], tf.indptr[1:])]
+            else:
+                rows = [enumerate(row) for row in tf]
+            params = np.full(len(rows), None)
+            for i, row in enumerate(rows):
+                terms = []
+                for j, t in row:
+                    if isinstance(t, numbers.Number):
+                        if t == 0:
+                            continue
+                        # plain float, so that the formula does not contain a numpy scalar repr
+                        t = float(t)
+                    elif t is None:
+                        continue
+                    terms.append(t * dependent[j])
+                if len(terms) == 0:
+                    params[i] = IndependentParameter(self.name + '_bin%d' % i, 0, constant=True)
+                else:
+                    params[i] = _pairwise_sum(np.array(terms))
+        params = np.array(params)
+        if not all(isinstance(p, Parameter) for p in params):
+            raise ValueError("TransferFactorSample expects the product of the transfer factor and dependent sample to be Parameter types.")
+        return params
+
     @property
     def transferfactor(self):
         return self._transferfactor
@@ -0,0 +1,359 @@
+'''
+A compact serialization format for rhalphalib object graphs (see Model.save and Model.load)
+
+The graph is flattened into a table of nodes in topological order (operands before the nodes using them),
+where each node has an opcode and a list of operands, stored in flat arrays:
+    opcodes[i]: the node type, one of the _OP constants below
+    operands[indptr[i]:indptr[i+1]]: node indices (for containers and objects), or indices into
+        the ints, floats, strings and buffers tables (for leaves)
+Strings (e.g. parameter names) are stored once in a single utf-8 buffer.  Numeric numpy arrays (templates,
+effects, binnings) are stored as contiguous buffers aligned to 16 bytes, so that they can be memory-mapped when loading.
+The index tables use the smallest unsigned integer type that holds their values.
+Objects of rhalphalib classes are stored as their class name and state dictionary, like pickle does;
+anything else that is not a basic python type or numpy array falls back to being pickled.
+
+File layout:
+    magic (8 bytes), header length (uint64 little endian), JSON header, padding, buffers
+'''
+from __future__ import division
+from collections import OrderedDict
+import importlib
+import json
+import mmap
+import pickle
+import struct
+import numpy as np
+from .parameter import Parameter, Observable
+
+_MAGIC = b'RHLBGRF1'
+_ALIGN = 16
+
+(_OP_NONE, _OP_BOOL, _OP_INT, _OP_FLOAT, _OP_STR, _OP_LIST, _OP_TUPLE, _OP_SET, _OP_FROZENSET,
+ _OP_DICT, _OP_ODICT, _OP_ARRAY, _OP_OBJARRAY, _OP_NPSCALAR, _OP_OBJECT, _OP_PICKLE) = range(16)
+
+_INT64 = np.iinfo(np.int64)
+
+
+class _Writer(object):
+    def __init__(self):
+        self._keys = {}
+        self._nodes = []
+        self._strings = OrderedDict()
+        self._ints = []
+        self._floats = []
+        self._buffers = []
+        self._alive = []
+
+    def _string(self, s):
+        return self._strings.setdefault(s, len(self._strings))
+
+    def _buffer(self, array):
+        # not ascontiguousarray, which makes 0-d arrays 1-d
+        self._buffers.append(np.asarray(array, order='C'))
+        return len(self._buffers) - 1
+
+    def _key(self, obj):
+        '''
+        Memo key of a node: basic values are deduplicated by value, everything else by identity
+        '''
+        tp = type(obj)
+        if obj is None or tp is bool or tp is str or (tp is int and _INT64.min <= obj <= _INT64.max):
+            return (tp.__name__, obj)
+        elif tp is float:
+            # repr distinguishes e.g. 0. and -0., and is exact
+            return ('float', repr(obj))
+        return id(obj)
+
+    def _classify(self, obj):
+        '''
+        Return the opcode and the list of child objects of a python object
+        '''
+        tp = type(obj)
+        if obj is None:
+            return _OP_NONE, ()
+        elif tp is bool:
+            return _OP_BOOL, ()
+        elif tp is int and _INT64.min <= obj <= _INT64.max:
+            return _OP_INT, ()
+        elif tp is float:
+            return _OP_FLOAT, ()
+        elif tp is str:
+            return _OP_STR, ()
+        elif tp is list:
+            return _OP_LIST, obj
+        elif tp is tuple:
+            return _OP_TUPLE, obj
+        elif tp is set:
+            return _OP_SET, list(obj)
+        elif tp is frozenset:
+            return _OP_FROZENSET, list(obj)
+        elif tp is dict:
+            return _OP_DICT, [x for item in obj.items() for x in item]
+        elif tp is OrderedDict:
+            return _OP_ODICT, [x for item in obj.items() for x in item]
+        elif tp is np.ndarray and obj.dtype.hasobject:
+            return _OP_OBJARRAY, list(obj.reshape(-1))
+        elif tp is np.ndarray and obj.dtype.names is None:
+            return _OP_ARRAY, ()
+        elif isinstance(obj, np.generic) and not obj.dtype.hasobject and obj.dtype.names is None:
+            return _OP_NPSCALAR, ()
+        elif _isRhalphalibClass(tp):
+            state = obj.__getstate__() if hasattr(obj, '__getstate__') else obj.__dict__
+            if state is None:
+                state = {}
+            if type(state) is not dict:
+                raise ValueError("Cannot serialize %r, its state is not a dictionary" % obj)
+            return _OP_OBJECT, [state]
+        return _OP_PICKLE, ()
+
+    def add(self, root):
+        '''
+        Add the graph reachable from root, returning the index of the root node
+        The traversal is iterative, so that deep graphs (e.g. long DependentParameter chains) are not
+        limited by the recursion limit.  Nodes are numbered in post-order, i.e. topologically.
+        '''
+        expandedKeys = set()
+        stack = [(root, None)]
+        while len(stack):
+            obj, expanded = stack.pop()
+            key = self._key(obj)
+            if expanded is not None:
+                self._keys[key] = len(self._nodes)
+                self._nodes.append((obj, ) + expanded)
+                continue
+            if key in expandedKeys:
+                continue
+            expandedKeys.add(key)
+            opcode, children = self._classify(obj)
+            # keep the children (e.g. a state dictionary returned by __getstate__) alive, as identity keys
+            # are only meaningful while the objects exist
+            self._alive.append(children)
+            stack.append((obj, (opcode, children)))
+            for child in reversed(children):
+                childKey = self._key(child)
+                if childKey not in expandedKeys:
+                    stack.append((child, None))
+                elif childKey not in self._keys and type(child) in (tuple, frozenset):
+                    # expanded but not done: an ancestor of this node.  Tuples and frozensets are created
+                    # complete from their contents when loading, so they cannot be part of a cycle
+                    raise ValueError("Cannot serialize a reference cycle through %r" % (child, ))
+        return self._keys[self._key(root)]
+
+    def tobytes(self, root):
+        iroot = self.add(root)
+        opcodes = np.empty(len(self._nodes), dtype=np.uint8)
+        indptr = np.zeros(len(self._nodes) + 1, dtype=np.int64)
+        operands = []
+        for i, (obj, opcode, children) in enumerate(self._nodes):
+            opcodes[i] = opcode
+            if opcode == _OP_NONE:
+                ops = []
+            elif opcode == _OP_BOOL:
+                ops = [int(obj)]
+            elif opcode == _OP_INT:
+                self._ints.append(obj)
+                ops = [len(self._ints) - 1]
+            elif opcode == _OP_FLOAT:
+                self._floats.append(obj)
+                ops = [len(self._floats) - 1]
+            elif opcode == _OP_STR:
+                ops = [self._string(obj)]
+            elif opcode in (_OP_ARRAY, _OP_NPSCALAR):
+                ops = [self._buffer(obj)]
+            elif opcode == _OP_PICKLE:
+                ops = [self._buffer(np.frombuffer(pickle.dumps(obj, protocol=2), dtype=np.uint8))]
+            elif opcode == _OP_OBJECT:
+                ops = [self._string(type(obj).__module__ + ':' + type(obj).__name__), self._keys[self._key(children[0])]]
+            elif opcode == _OP_OBJARRAY:
+                ops = [obj.ndim] + list(obj.shape) + [self._keys[self._key(child)] for child in children]
+            else:
+                ops = [self._keys[self._key(child)] for child in children]
+            operands.extend(ops)
+            indptr[i + 1] = len(operands)
+
+        encoded = [s.encode('utf-8') for s in self._strings]
+        tables = OrderedDict([
+            ('opcodes', opcodes),
+            ('indptr', _compact(indptr)),
+            ('operands', _compact(operands)),
+            ('ints', np.array(self._ints, dtype=np.int64)),
+            ('floats', np.array(self._floats, dtype=np.float64)),
+            ('strings', np.frombuffer(b''.join(encoded), dtype=np.uint8)),
+            ('stroffsets', _compact(np.cumsum([0] + [len(s) for s in encoded]))),
+        ])
+        buffers = list(tables.values()) + self._buffers
+        offset = 0
+        descriptors = []
+        for buf in buffers:
+            descriptors.append((buf.dtype.str, buf.shape, offset))
+            offset += -(-buf.nbytes // _ALIGN) * _ALIGN
+        header = json.dumps({
+            'root': iroot,
+            'tables': {name: i for i, name in enumerate(tables)},
+            'buffers': descriptors,
+        }).encode('utf-8')
+        start = -(-(len(_MAGIC) + 8 + len(header)) // _ALIGN) * _ALIGN
+        out = bytearray(start + offset)
+        out[:len(_MAGIC)] = _MAGIC
+        out[len(_MAGIC):len(_MAGIC) + 8] = struct.pack('<Q', len(header))
+        out[len(_MAGIC) + 8:len(_MAGIC) + 8 + len(header)] = header
+        for buf, (_, _, bufoffset) in zip(buffers, descriptors):
+            out[start + bufoffset:start + bufoffset + buf.nbytes] = buf.tobytes()
+        return bytes(out)
+
+
+def _compact(indices):
+    '''
+    An array of non-negative integers in the smallest unsigned type that can hold them
+    '''
+    indices = np.asarray(indices, dtype=np.int64)
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if indices.size == 0 or indices.max() <= np.iinfo(dtype).max:
+            return indices.astype(dtype)
+    return indices.astype(np.uint64)
+
+
+def _isRhalphalibClass(cls):
+    return any(base.__module__.split('.')[0] == 'rhalphalib' for base in cls.__mro__)
+
+
+def _resolve(name):
+    module, clsname = name.split(':')
+    cls = getattr(importlib.import_module(module), clsname)
+    if not _isRhalphalibClass(cls):
+        raise ValueError("Refusing to load %s, which does not derive from a rhalphalib class" % name)
+    return cls
+
+
+def _fromBuffer(data, shared=None):
+    '''
+    Rebuild the object graph from data, an array of uint8.  Numeric arrays are views
+    into data, hence share its memory (and its memory map, if it is one)
+    shared: optional dictionary of parameter name -> parameter, see loads
+    '''
+    if bytes(data[:len(_MAGIC)]) != _MAGIC:
+        raise ValueError("Not a rhalphalib serialized object")
+    headerlen, = struct.unpack('<Q', bytes(data[len(_MAGIC):len(_MAGIC) + 8]))
+    header = json.loads(bytes(data[len(_MAGIC) + 8:len(_MAGIC) + 8 + headerlen]).decode('utf-8'))
+    start = -(-(len(_MAGIC) + 8 + headerlen) // _ALIGN) * _ALIGN
+
+    def buffer(i):
+        dtype, shape, offset = header['buffers'][i]
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        return data[start + offset:start + offset + nbytes].view(dtype).reshape(shape)
+
+    tables = {name: buffer(i) for name, i in header['tables'].items()}
+    # buffers referenced by nodes follow the tables
+    nodeBuffer = len(tables)
+    # python lists are much faster than arrays to index element by element
+    opcodes, indptr, operands = tables['opcodes'].tolist(), tables['indptr'].tolist(), tables['operands'].tolist()
+    ints, floats, stroffsets = tables['ints'].tolist(), tables['floats'].tolist(), tables['stroffsets'].tolist()
+    strings = bytes(tables['strings'])
+
+    def string(i):
+        return strings[stroffsets[i]:stroffsets[i + 1]].decode('utf-8')
+
+    nodes = [None] * len(opcodes)
+    # first pass: leaves and empty shells of mutable nodes, which may be referenced before they are filled
+    for i, opcode in enumerate(opcodes):
+        ops = operands[indptr[i]:indptr[i + 1]]
+        if opcode == _OP_BOOL:
+            nodes[i] = bool(ops[0])
+        elif opcode == _OP_INT:
+            nodes[i] = ints[ops[0]]
+        elif opcode == _OP_FLOAT:
+            nodes[i] = floats[ops[0]]
+        elif opcode == _OP_STR:
+            nodes[i] = string(ops[0])
+        elif opcode == _OP_LIST:
+            nodes[i] = []
+        elif opcode == _OP_SET:
+            nodes[i] = set()
+        elif opcode == _OP_DICT:
+            nodes[i] = {}
+        elif opcode == _OP_ODICT:
+            nodes[i] = OrderedDict()
+        elif opcode == _OP_ARRAY:
+            nodes[i] = buffer(nodeBuffer + ops[0])
+        elif opcode == _OP_NPSCALAR:
+            nodes[i] = buffer(nodeBuffer + ops[0])[()]
+        elif opcode == _OP_OBJARRAY:
+            nodes[i] = np.empty(tuple(ops[1:1 + ops[0]]), dtype=object)
+        elif opcode == _OP_OBJECT:
+            cls = _resolve(string(ops[0]))
+            nodes[i] = cls.__new__(cls)
+        elif opcode == _OP_PICKLE:
+            nodes[i] = pickle.loads(buffer(nodeBuffer + ops[0]).tobytes())
+    # second pass, in topological order: fill containers and objects
+    for i, opcode in enumerate(opcodes):
+        ops = operands[indptr[i]:indptr[i + 1]]
+        if opcode == _OP_LIST:
+            nodes[i].extend(nodes[j] for j in ops)
+        elif opcode == _OP_TUPLE:
+            nodes[i] = tuple(nodes[j] for j in ops)
+        elif opcode == _OP_SET:
+            nodes[i].update(nodes[j] for j in ops)
+        elif opcode == _OP_FROZENSET:
+            nodes[i] = frozenset(nodes[j] for j in ops)
+        elif opcode in (_OP_DICT, _OP_ODICT):
+            for k, v in zip(ops[0::2], ops[1::2]):
+                nodes[i][nodes[k]] = nodes[v]
+        elif opcode == _OP_OBJARRAY:
+            flat = nodes[i].reshape(-1)
+            for n, j in enumerate(ops[1 + ops[0]:]):
+                flat[n] = nodes[j]
+        elif opcode == _OP_OBJECT:
+            state = nodes[ops[1]]
+            if hasattr(nodes[i], '__setstate__'):
+                nodes[i].__setstate__(state)
+            else:
+                nodes[i].__dict__.update(state)
+            if shared is not None and _isShared(nodes[i]):
+                # nodes referencing this one come later in the order, so they pick up the shared instance
+                loaded = nodes[i]
+                nodes[i] = shared.setdefault(loaded.name, loaded)
+                if type(nodes[i]) is not type(loaded):
+                    raise ValueError("Parameter %s is a %s, but is shared as a %s" % (loaded.name, type(loaded).__name__, type(nodes[i]).__name__))
+    return nodes[header['root']]
+
+
+def _isShared(obj):
+    # intermediate parameters have generated names, which need not be unique
+    return isinstance(obj, Parameter) and not isinstance(obj, Observable) and not obj.intermediate
+
+
+def dumps(obj):
+    '''
+    Serialize the object graph reachable from obj to bytes
+    '''
+    return _Writer().tobytes(obj)
+
+
+def loads(data, shared=None):
+    '''
+    Rebuild an object graph from bytes produced by dumps
+        shared: optional dictionary of parameter name -> parameter.  Loaded (non-intermediate) parameters
+            with a name in shared are replaced by that instance, and the others are added to it,
+            so that graphs loaded with the same dictionary share their parameters by name.
+    '''
+    return _fromBuffer(np.frombuffer(bytearray(data), dtype=np.uint8), shared)
+
+
+def save(obj, path):
+    with open(path, 'wb') as fout:
+        fout.write(dumps(obj))
+
+
+def load(path, mmap_buffers=True):
+    '''
+    Load an object graph from path.  If mmap_buffers is True, the numeric arrays are copy-on-write
+    memory maps of the file, read from disk on demand, rather than being read in upfront
+    '''
+    if mmap_buffers:
+        with open(path, 'rb') as fin:
+            data = np.frombuffer(mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_COPY), dtype=np.uint8)
+    else:
+        with open(path, 'rb') as fin:
+            data = np.frombuffer(bytearray(fin.read()), dtype=np.uint8)
+    return _fromBuffer(data)
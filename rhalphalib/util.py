@@ -1,3 +1,6 @@
+import functools
+import hashlib
+import numbers
 import numpy as np
 
 
@@ -55,6 +58,19 @@ def _to_TH1(sumw, binning, name):
     return h
 
 
+def _merge_indices(binning, new_binning):
+    '''
+    Find the bins of binning where each bin of new_binning starts, i.e. the indices to use with np.add.reduceat
+    The edges of new_binning must be a subset of those of binning, with the same endpoints.
+    '''
+    binning = np.asarray(binning)
+    new_binning = np.asarray(new_binning)
+    idx = np.abs(np.subtract.outer(binning, new_binning)).argmin(axis=0)
+    if not (np.allclose(binning[idx], new_binning) and idx[0] == 0 and idx[-1] == binning.size - 1 and np.all(np.diff(idx) > 0)):
+        raise ValueError("Binning %r cannot be obtained by merging bins of %r" % (new_binning, binning))
+    return idx[:-1]
+
+
 def _pairwise_sum(array):
     if len(array) == 1:
         return array[0]
@@ -64,6 +80,110 @@ def _pairwise_sum(array):
     return _pairwise_sum(array[0::2] + array[1::2])
 
 
+# attributes that hold caches or bookkeeping rather than content
+_FINGERPRINT_SKIP = frozenset(['_cache', '_version', '_registry'])
+
+
+def _fingerprint(obj):
+    '''
+    A stable hex digest of the content of obj, which may be any graph of
+    rhalphalib objects, containers, numpy arrays and plain values.
+    Objects are identified by their attributes, not by their id, so that equal
+    content built in separate processes gives an equal digest.
+    '''
+    hasher = hashlib.sha1()
+    _fingerprint_update(hasher, obj, {})
+    return hasher.hexdigest()
+
+
+def _fingerprint_update(hasher, obj, memo):
+    def put(*tokens):
+        for token in tokens:
+            hasher.update(str(token).encode('utf8'))
+            hasher.update(b'\0')
+
+    if obj is None or isinstance(obj, (bool, numbers.Number, np.generic, str, bytes)):
+        put(type(obj).__name__, repr(obj))
+    elif isinstance(obj, np.ndarray):
+        put('ndarray', obj.dtype.str, obj.shape)
+        if obj.dtype == object:
+            for item in obj.reshape(-1):
+                _fingerprint_update(hasher, item, memo)
+        else:
+            hasher.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        put(type(obj).__name__, len(obj))
+        for item in obj:
+            _fingerprint_update(hasher, item, memo)
+    elif isinstance(obj, (set, frozenset)):
+        # order by content, as iteration order of sets of objects is not stable
+        put('set', len(obj))
+        for digest in sorted(_fingerprint(item) for item in obj):
+            put(digest)
+    elif isinstance(obj, dict):
+        put('dict', len(obj))
+        items = sorted(((_fingerprint(key), value) for key, value in obj.items()), key=lambda item: item[0])
+        for digest, value in items:
+            put(digest)
+            _fingerprint_update(hasher, value, memo)
+    elif id(obj) in memo:
+        put('ref', memo[id(obj)])
+    else:
+        memo[id(obj)] = len(memo)
+        state = (obj.__getstate__() if hasattr(obj, '__getstate__') else obj.__dict__) or {}
+        put(type(obj).__name__)
+        for key in sorted(state):
+            if key not in _FINGERPRINT_SKIP:
+                put(key)
+                _fingerprint_update(hasher, state[key], memo)
+
+
+class _RenderContext(object):
+    '''
+    Maps rhalphalib nodes to the RooFit objects rendered from them into one workspace,
+    so that each node is rendered and looked up in the workspace only once.
+    The context lives on the python object of the workspace, see _RenderContext.of
+    '''
+    def __init__(self):
+        self._rendered = {}
+
+    @classmethod
+    def of(cls, workspace):
+        context = getattr(workspace, '_rhalphalib_render_context', None)
+        if context is None:
+            context = cls()
+            workspace._rhalphalib_render_context = context
+        return context
+
+    def __len__(self):
+        return len(self._rendered)
+
+    def get(self, node):
+        # the name is part of the key since nodes may be renamed, e.g. when a sample builds its expectation
+        item = self._rendered.get((id(node), node.name))
+        return None if item is None else item[1]
+
+    def add(self, node, rendered):
+        # keep a reference to the node so that its id cannot be reused during the render
+        self._rendered[(id(node), node.name)] = (node, rendered)
+
+
+def _render_once(renderRoofit):
+    '''
+    Decorator for renderRoofit methods, returning the result of the first
+    call for a given node and workspace from the workspace render context
+    '''
+    @functools.wraps(renderRoofit)
+    def wrapper(self, workspace):
+        context = _RenderContext.of(workspace)
+        rendered = context.get(self)
+        if rendered is None:
+            rendered = renderRoofit(self, workspace)
+            context.add(self, rendered)
+        return rendered
+    return wrapper
+
+
 ROOFIT_HELPERS_INSTALLED = False
 
 
@@ -0,0 +1,50 @@
+'''
+Compare the NLL evaluation time of a ParametericSample rendered as a RooParametricHist
+with the RooParametricStepFunction fallback, used when RooParametricHist is not available.
+Usage: python benchmark_parametric.py [nbins] [nevals]
+'''
+from __future__ import print_function, division
+import sys
+import timeit
+import numpy as np
+import rhalphalib as rl
+import ROOT
+rl.util.install_roofit_helpers()
+
+
+def build_channel(nbins):
+    x = rl.Observable('x', np.linspace(0, 1, nbins + 1))
+    ch = rl.Channel('bench')
+    nominal = 1000. * np.exp(-5. * x.binning[:-1])
+    qcdparams = np.array([rl.IndependentParameter('qcdparam_bin%d' % i, 0, -10, 10) for i in range(nbins)])
+    ch.addSample(rl.ParametericSample('bench_qcd', rl.Sample.BACKGROUND, x, nominal * 1.1**qcdparams))
+    ch.setObservation((np.random.poisson(nominal).astype(float), x.binning, x.name))
+    return ch
+
+
+def benchmark(preferParametricHist, nbins, nevals):
+    rl.ParametericSample.PreferRooParametricHist = preferParametricHist
+    ws = ROOT.RooWorkspace('bench')
+    pdf, data = build_channel(nbins).renderRoofit(ws)
+    nll = pdf.createNLL(data, ROOT.RooFit.Extended(True))
+    params = [ws.var('qcdparam_bin%d' % i) for i in range(nbins)]
+    rng = np.random.RandomState(0)
+
+    def evaluate():
+        # move one parameter, as in a minimizer gradient step
+        params[rng.randint(nbins)].setVal(rng.normal())
+        nll.getVal()
+
+    return timeit.timeit(evaluate, number=nevals) / nevals
+
+
+if __name__ == '__main__':
+    nbins = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    nevals = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    modes = [('RooParametricStepFunction', False)]
+    if hasattr(ROOT, 'RooParametricHist'):
+        modes.insert(0, ('RooParametricHist', True))
+    else:
+        print("RooParametricHist not available (is combine loaded?), timing the fallback only")
+    for label, prefer in modes:
+        print("%-26s %d bins: %8.1f us per NLL evaluation" % (label, nbins, 1e6 * benchmark(prefer, nbins, nevals)))
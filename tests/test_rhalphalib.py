@@ -4,7 +4,10 @@ import os
 import rhalphalib as rl
 import numpy as np
 import scipy.stats
+import scipy.sparse
 import pickle
+import warnings
+import weakref
 import ROOT
 rl.util.install_roofit_helpers()
 rl.ParametericSample.PreferRooParametricHist = False
@@ -295,6 +298,833 @@ def test_monojet(tmpdir):
     model.renderCombine(os.path.join(str(tmpdir), 'monojetModel'))
 
 
+def test_autoMCStats(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    ch = rl.Channel('sr')
+    for sName, norm in [('bkg1', 100.), ('bkg2', 0.5)]:
+        sumw = expo_sample(norm, 50, mjj)[0]
+        ch.addSample(rl.TemplateSample('sr_' + sName, rl.Sample.BACKGROUND, (sumw, mjj.binning, mjj.name, sumw * 0.1)))
+    ch.setObservation(expo_sample(100, 50, mjj))
+    ch.autoMCStats(threshold=10)
+
+    pnames = {p.name for p in ch.parameters}
+    assert 'prop_binsr_bin0' in pnames
+    assert 'prop_binsr_bin0_bkg1' not in pnames
+
+    cardname = os.path.join(str(tmpdir), 'sr.txt')
+    ch.renderCard(cardname, 'ws')
+    with open(cardname) as fin:
+        card = fin.read()
+    assert 'sr autoMCStats 10 0 1' in card
+    assert 'prop_bin' not in card
+
+    # below threshold, each sample gets its own (gaussian) parameter per bin
+    ch = rl.Channel('lowstat')
+    sumw = expo_sample(1., 50, mjj)[0]
+    bkg = rl.TemplateSample('lowstat_bkg', rl.Sample.BACKGROUND, (sumw, mjj.binning, mjj.name, sumw * 0.5))
+    ch.addSample(bkg)
+    ch.addSample(rl.TemplateSample('lowstat_sig', rl.Sample.SIGNAL, (sumw, mjj.binning, mjj.name, sumw * 0.5)))
+    ch.setObservation(expo_sample(1., 50, mjj))
+    ch.autoMCStats(threshold=10)
+    assert {p.name for p in ch.parameters} == {'prop_binlowstat_bin%d_bkg' % i for i in range(mjj.nbins)}
+    param = ch.registry['prop_binlowstat_bin3_bkg']
+    assert bkg.getParamEffect(param)[3] == (sumw[3] + np.sqrt(sumw[3] * 0.5)) / sumw[3]
+    assert bkg.getParamEffect(param, up=False)[3] == max(1 - np.sqrt(sumw[3] * 0.5) / sumw[3], 0.)
+    assert np.array_equal(np.delete(bkg.getParamEffect(param), 3), np.ones(mjj.nbins - 1))
+    cardname = os.path.join(str(tmpdir), 'lowstat.txt')
+    ch.renderCard(cardname, 'ws')
+    with open(cardname) as fin:
+        card = fin.read()
+    assert 'lowstat autoMCStats 10 0 1' in card
+    assert 'prop_bin' not in card
+
+
+def test_setParamEffects(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    templ = expo_sample(100, 50, mjj)
+    templ[0][0] = 0.
+
+    def check(params, effects_up, effects_down=None, scales=None):
+        bulk = rl.TemplateSample('sr_bulk', rl.Sample.BACKGROUND, templ)
+        bulk.setParamEffects(params, effects_up, effects_down, scales)
+        single = rl.TemplateSample('sr_single', rl.Sample.BACKGROUND, templ)
+
+        def value(effects, i):
+            # python numbers for normalization effects, rows for shape effects
+            return None if effects is None else (effects[i].item() if effects.ndim == 1 else effects[i])
+
+        for i, param in enumerate(params):
+            single.setParamEffect(param, value(effects_up, i), value(effects_down, i), value(np.broadcast_to(scales, len(params)) if scales is not None else None, i))
+        assert bulk.parameters == single.parameters
+        for param in single.parameters:
+            for up in [True, False]:
+                effect = bulk.getParamEffect(param, up)
+                assert type(effect) is type(single.getParamEffect(param, up))
+                assert np.array_equal(effect, single.getParamEffect(param, up))
+        assert bulk._paramEffectScales == single._paramEffectScales
+        assert all(type(v) is float for v in bulk._paramEffectScales.values())
+        return bulk
+
+    norms = [rl.NuisanceParameter('norm%d' % i, 'lnN') for i in range(3)]
+    shapes = [rl.NuisanceParameter('shape%d' % i, 'shape') for i in range(4)]
+    # norm rows, including a trivial one, symmetric and asymmetric
+    bulk = check(norms, np.array([1.1, 1., 0.95]))
+    assert bulk.parameters == {norms[0], norms[2]}
+    check(norms, np.array([1.1, 1.2, 0.95]), np.array([0.9, 0.85, 1.05]), scales=2.)
+    # shape priors with a normalization-like effect get a full row
+    check(shapes[:2], np.array([1.1, 1.2]))
+    # shape rows, including a trivial one and one without impact on the nonzero bins
+    up = np.random.normal(1, 0.1, size=(4, mjj.nbins))
+    up[1] = 1.
+    up[2] = 0.
+    up[2, 0] = 2.
+    down = np.random.normal(1, 0.1, size=(4, mjj.nbins))
+    bulk = check(shapes, up, scales=[1., 2., 3., 4.])
+    assert bulk.parameters == {shapes[0], shapes[3]}
+    check(shapes, up, down, scales=0.5)
+    # lnN parameters with per-bin effects
+    check(norms, np.random.normal(1, 0.1, size=(3, mjj.nbins)), np.array([0.9, 0.85, 1.05]))
+
+    sample = rl.TemplateSample('sr_bulk', rl.Sample.BACKGROUND, templ)
+    for effects_up, effects_down in [(np.ones((2, mjj.nbins + 1)), None), (np.ones(3), None), (np.ones(2), np.ones((3, mjj.nbins)))]:
+        try:
+            sample.setParamEffects(shapes[:2], effects_up, effects_down)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected a ValueError for effects of the wrong shape")
+    try:
+        sample.setParamEffects([rl.IndependentParameter('free', 1.)], np.ones(1))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected a ValueError for a non-nuisance parameter")
+
+
+def test_expectationCache(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    jes = rl.NuisanceParameter('jes', 'shape')
+    lumi = rl.NuisanceParameter('lumi', 'lnN')
+    bkg = rl.TemplateSample('sr_bkg', rl.Sample.BACKGROUND, expo_sample(100, 50, mjj))
+    fail = rl.ParametericSample('fail_qcd', rl.Sample.BACKGROUND, mjj, np.array([rl.IndependentParameter('fail_bin%d' % i, 1.) for i in range(mjj.nbins)]))
+    tf = rl.TransferFactorSample('pass_qcd', rl.Sample.BACKGROUND, np.full(mjj.nbins, 0.5), fail)
+
+    mask = np.ones(mjj.nbins, dtype=bool)
+    mask[-1] = False
+    modifications = [
+        (bkg, lambda: bkg.setParamEffect(jes, np.linspace(0.9, 1.1, mjj.nbins))),
+        (bkg, lambda: bkg.setParamEffect(lumi, 1.02)),
+        (bkg, lambda: bkg.scale(2.)),
+        (bkg, lambda: setattr(bkg, 'mask', mask)),
+        (bkg, lambda: bkg.removeParamEffect(lumi)),
+        (fail, lambda: fail.setParamEffect(jes, np.full(mjj.nbins, 1.1))),
+        (fail, lambda: setattr(fail, 'mask', mask)),
+        (tf, lambda: tf.setParamEffect(lumi, np.full(mjj.nbins, 1.02))),
+    ]
+    for sample, modify in modifications:
+        expectation, parameters, version = sample.getExpectation(), sample.parameters, sample.version
+        assert sample.getExpectation() is expectation
+        assert sample.parameters is parameters
+        modify()
+        assert sample.version > version
+        assert sample.getExpectation() is not expectation
+        assert sample.getExpectation() is sample.getExpectation()
+    assert jes in bkg.parameters and lumi not in bkg.parameters
+    assert bkg.getExpectation(nominal=True)[-1] == 0.
+
+    # the transfer factor sample follows the sample it depends on
+    expectation, version = tf.getExpectation(), tf.version
+    fail.setParamEffect(lumi, 1.05)
+    assert tf.version > version
+    assert tf.getExpectation() is not expectation
+    assert lumi in tf.parameters
+    assert tf.getExpectation()[0].getDependents(deep=True) == fail.getExpectation()[0].getDependents(deep=True)
+
+
+def test_parameterRegistry(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    lumi, jes = rl.NuisanceParameter('lumi', 'lnN'), rl.NuisanceParameter('jes', 'shape')
+    model = rl.Model('registryModel')
+    ch = rl.Channel('sr')
+    model.addChannel(ch)
+    bkg = rl.TemplateSample('sr_bkg', rl.Sample.BACKGROUND, expo_sample(100, 50, mjj))
+    bkg.setParamEffect(lumi, 1.02)
+    ch.addSample(bkg)
+    yields = np.array([rl.IndependentParameter('sr_qcd_bin%d' % i, 1.) for i in range(mjj.nbins)])
+    qcd = rl.ParametericSample('sr_qcd', rl.Sample.BACKGROUND, mjj, yields)
+    qcd.setParamEffect(lumi, 1.02)
+    ch.addSample(qcd)
+
+    registry = model.registry
+    names = ['lumi'] + ['sr_qcd_bin%d' % i for i in range(mjj.nbins)]
+    assert [p.name for p in registry] == sorted(names)
+    assert registry.nuisances == [lumi]
+    assert [p.name for p in registry.independents] == sorted(names)
+    assert registry.unconstrained == sorted(yields, key=lambda p: p.name)
+    assert np.array_equal(registry.index(['sr_qcd_bin0', 'lumi', 'nope']), [1, 0, -1])
+
+    # a parameter used by two samples stays registered until neither uses it
+    version = registry.version
+    bkg.removeParamEffect(lumi)
+    assert model.registry is registry and registry.version == version and 'lumi' in registry
+    qcd.setParamEffect(jes, np.full(mjj.nbins, 1.1))
+    assert registry.version == version and 'jes' not in registry
+    model.registry
+    assert registry.version == version + 1 and registry['jes'] is jes
+    assert registry.nuisances == [jes, lumi]
+    del ch._samples['sr_qcd']
+    assert len(model.registry) == 0 and 'lumi' not in registry
+
+    # lookups by name follow renames of registered parameters
+    ch.addSample(qcd)
+    yields[3].name = 'renamed'
+    assert model.registry.get('sr_qcd_bin3') is None
+    assert model.registry.get('renamed') is yields[3]
+    assert model.registry.independents[:3] == [jes, lumi, yields[3]]
+    model.setParameterValues({'renamed': 3.})
+    assert yields[3].value == 3.
+
+
+def test_parameterValues(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    lumi = rl.NuisanceParameter('lumi', 'lnN')
+    model = rl.Model('valuesModel')
+    ch = rl.Channel('sr')
+    model.addChannel(ch)
+    yields = np.array([rl.IndependentParameter('sr_qcd_bin%d' % i, 1.) for i in range(mjj.nbins)])
+    qcd = rl.ParametericSample('sr_qcd', rl.Sample.BACKGROUND, mjj, yields)
+    qcd.setParamEffect(lumi, 1.02)
+    ch.addSample(qcd)
+
+    names = [p.name for p in model.registry.independents]
+    assert names == sorted(['lumi'] + ['sr_qcd_bin%d' % i for i in range(mjj.nbins)])
+    values = np.arange(len(names), dtype=float)
+    model.setParameterValues(values)
+    assert np.array_equal(model.getParameterValues(), values)
+    assert lumi.value == 0. and yields[0].value == 1.
+
+    model.setParameterValues({'sr_qcd_bin2': 7., 'lumi': 0.5, 'unknown': 3.})
+    assert yields[2].value == 7. and lumi.value == 0.5
+    model.setParameterValues([8., 9., 10.], names=['sr_qcd_bin2', 'unknown', 'sr_qcd_bin9'])
+    assert yields[2].value == 8. and yields[9].value == 10.
+    values = model.getParameterValues()
+    model.setParameterValues(values * 2)
+    model.setParameterValues(dict(zip(names, values)))
+    assert np.array_equal(model.getParameterValues(), values)
+
+    for args in [(np.ones(len(names) - 1), ), (np.ones((len(names), 2)), ), ([1., 2.], ['lumi'])]:
+        try:
+            model.setParameterValues(*args)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected a ValueError for mismatched values")
+    assert np.array_equal(model.getParameterValues(), values)
+
+    # renamed after the registry was built
+    yields[4].name = 'sr_qcd_renamed'
+    model.setParameterValues({'sr_qcd_renamed': -1., 'sr_qcd_bin4': -2.})
+    assert yields[4].value == -1.
+    assert model.getParameterValues()[[p.name for p in model.registry.independents].index('sr_qcd_renamed')] == -1.
+
+
+def test_combineParamEffects(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 5))
+    ch = rl.Channel('sr')
+    sample = rl.TemplateSample('sr_bkg', rl.Sample.BACKGROUND, (np.array([10., 20., 30., 40.]), mjj.binning, mjj.name))
+    ch.addSample(sample)
+    ch.setObservation((np.array([10., 20., 30., 40.]), mjj.binning, mjj.name))
+    rate = rl.IndependentParameter('rate', 1., 0, 10)
+    params = [rl.NuisanceParameter(name, 'lnN') for name in ['sym', 'asym', 'scaled', 'binned', 'binnedasym', 'mixed', 'mixedscaled', 'unused']]
+    params += [rl.NuisanceParameter(name, 'shape') for name in ['shape', 'shapescaled']] + [rate]
+    sample.setParamEffect(params[0], 1.05)
+    sample.setParamEffect(params[1], 1.05, 0.97)
+    sample.setParamEffect(params[2], 1.05, 0.97, scale=2.)
+    sample.setParamEffect(params[3], np.array([1.1, 1.2, 1.1, 1.0]))
+    sample.setParamEffect(params[4], np.array([1.1, 1.2, 1.1, 1.0]), np.array([0.9, 0.8, 1.0, 0.95]))
+    sample.setParamEffect(params[5], np.array([1.1, 1.2, 1.1, 1.0]), 0.9)
+    sample.setParamEffect(params[6], np.array([1.1, 1.2, 1.1, 1.0]), 0.9, scale=0.5)
+    sample.setParamEffect(params[8], np.array([1.1, 1.2, 1.1, 1.0]))
+    sample.setParamEffect(params[9], np.array([1.1, 1.2, 1.1, 1.0]), scale=3.)
+    sample.setParamEffect(rate, 2 * rate)
+
+    expected = [sample.combineParamEffect(p) for p in params]
+    assert sample.combineParamEffects(params) == expected
+    assert expected[5] == '1.080/0.900'
+    assert expected[7] == '-'
+
+    cardname = os.path.join(str(tmpdir), 'mixed.txt')
+    ch.renderCard(cardname, 'ws')
+    with open(cardname) as fin:
+        rows = {line.split()[0]: line.split()[1:] for line in fin if line.strip()}
+    assert rows['mixed'] == ['lnN', '1.080/0.900']
+
+
+def test_parameterValuesFitResult(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    model = rl.Model('fitModel')
+    ch = rl.Channel('sr')
+    model.addChannel(ch)
+    yields = np.array([rl.IndependentParameter('sr_qcd_bin%d' % i, 1., 0, 100) for i in range(mjj.nbins)])
+    ch.addSample(rl.ParametericSample('sr_qcd', rl.Sample.BACKGROUND, mjj, yields))
+    ch.setObservation(expo_sample(100, 50, mjj))
+    # renamed after the registry was built, but before rendering
+    assert model.registry.get('sr_qcd_bin5') is yields[5]
+    yields[5].name = 'sr_qcd_renamed'
+
+    ws = ROOT.RooWorkspace('ws')
+    simpdf, obs = model.renderRoofit(ws)
+    fit = simpdf.fitTo(obs, ROOT.RooFit.Extended(True), ROOT.RooFit.Save(), ROOT.RooFit.PrintLevel(-1))
+    fitValues = {p.GetName(): p.getVal() for p in fit.floatParsFinal()}
+    assert 'sr_qcd_renamed' in fitValues
+
+    model.setParameterValues(np.zeros(mjj.nbins))
+    model.setParameterValues(fit)
+    assert {p.name: p.value for p in model.registry.independents} == fitValues
+
+
+def test_pruneEffects(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    model = rl.Model('pruneModel')
+    ch = rl.Channel('sr')
+    model.addChannel(ch)
+    sample = rl.TemplateSample('sr_bkg', rl.Sample.BACKGROUND, expo_sample(100, 50, mjj))
+    big, small = rl.NuisanceParameter('big', 'lnN'), rl.NuisanceParameter('small', 'lnN')
+    bigshape, smallshape = rl.NuisanceParameter('bigshape', 'shape'), rl.NuisanceParameter('smallshape', 'shape')
+    sample.setParamEffect(big, 1.05)
+    sample.setParamEffect(small, 1.0001)
+    sample.setParamEffect(bigshape, np.linspace(0.9, 1.1, mjj.nbins))
+    sample.setParamEffect(smallshape, np.linspace(0.9999, 1.0001, mjj.nbins))
+    ch.addSample(sample)
+
+    report = model.pruneEffects(norm_threshold=1e-3, shape_threshold=1e-3)
+    assert report == {'sr': {'sr_bkg': ['small', 'smallshape']}}
+    assert sample.parameters == {big, bigshape}
+
+
+def test_rebin(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    ch = rl.Channel('sr')
+    jes = rl.NuisanceParameter('jes', 'shape')
+    templ = expo_sample(100, 50, mjj)
+    bkg = rl.TemplateSample('sr_bkg', rl.Sample.BACKGROUND, templ + (templ[0] * 0.1, ))
+    bkg.setParamEffect(jes, np.linspace(0.9, 1.1, mjj.nbins))
+    ch.addSample(bkg)
+    yields = np.array([rl.IndependentParameter('sr_qcd_bin%d' % i, 1.) for i in range(mjj.nbins)])
+    ch.addSample(rl.ParametericSample('sr_qcd', rl.Sample.BACKGROUND, mjj, yields))
+    ch.setObservation(expo_sample(120, 50, mjj))
+    mask = np.ones(mjj.nbins, dtype=bool)
+    mask[-2:] = False
+    ch.mask = mask
+
+    nominal = bkg.getExpectation(nominal=True)
+    jes_up = (nominal * bkg.getParamEffect(jes)).sum()
+    observation = ch.getObservation().sum()
+    ch.mergeBins([[0], [1, 2], [3, 4, 5, 6, 7], [8, 9]])
+
+    assert np.array_equal(ch.observable.binning, [0., 10., 30., 80., 100.])
+    assert np.array_equal(ch.mask, [True, True, True, False])
+    assert np.isclose(bkg.getExpectation(nominal=True).sum(), nominal.sum())
+    assert np.isclose((bkg.getExpectation(nominal=True) * bkg.getParamEffect(jes)).sum(), jes_up)
+    assert np.isclose(ch.getObservation().sum(), observation)
+    assert set(yields[:8]) <= ch['qcd'].parameters
+
+    ch.mergeBins(min_background=1e3)
+    assert ch.observable.nbins == 1
+
+
+def test_rebinTransferFactor(tmpdir):
+    msd = rl.Observable('msd', np.linspace(40, 200, 9))
+
+    def passFailModel():
+        model = rl.Model('tfModel')
+        failCh, passCh = rl.Channel('fail'), rl.Channel('pass')
+        model.addChannel(failCh)
+        model.addChannel(passCh)
+        yields = np.array([rl.IndependentParameter('fail_qcd_bin%d' % i, 10. * (i + 1)) for i in range(msd.nbins)])
+        fail = rl.ParametericSample('fail_qcd', rl.Sample.BACKGROUND, msd, yields)
+        failCh.addSample(fail)
+        passCh.addSample(rl.TransferFactorSample('pass_qcd', rl.Sample.BACKGROUND, np.linspace(0.1, 0.8, msd.nbins), fail))
+        return model, yields
+
+    edges = [40., 80., 120., 200.]
+    groups = [[0, 1], [2, 3], [4, 5, 6, 7]]
+    # each merged pass bin is the transfer factor times the fail yields of its bins, whichever channel comes first
+    for order in [['pass', 'fail'], ['fail', 'pass']]:
+        model, yields = passFailModel()
+        model.rebin(edges, order)
+        assert model['pass'].observable.nbins == model['fail'].observable.nbins == 3
+        bins = model['pass_qcd'].getExpectation()
+        assert [p.getDependents(deep=True) for p in bins] == [set(yields[g]) for g in groups]
+
+    # rebinning the transfer factor without its dependent sample is an error
+    model, _ = passFailModel()
+    for rebin in [lambda: model['pass'].rebin(edges), lambda: model.rebin(edges, ['pass'])]:
+        try:
+            rebin()
+        except ValueError as err:
+            assert 'fail_qcd' in str(err)
+        else:
+            raise AssertionError("Expected a ValueError when rebinning a transfer factor without its dependent sample")
+
+
+def test_combinedCard(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    lumi, jes = rl.NuisanceParameter('lumi', 'lnN'), rl.NuisanceParameter('jes', 'lnN')
+    model = rl.Model('combModel')
+    for chName in ['sr', 'cr']:
+        ch = rl.Channel(chName)
+        model.addChannel(ch)
+        sig = rl.TemplateSample(chName + '_sig', rl.Sample.SIGNAL, gaus_sample(10, 50, 10, mjj))
+        sig.setParamEffect(lumi, 1.02)
+        ch.addSample(sig)
+        bkg = rl.TemplateSample(chName + '_bkg', rl.Sample.BACKGROUND, expo_sample(100, 50, mjj))
+        bkg.setParamEffect(lumi, 1.02)
+        if chName == 'cr':
+            bkg.setParamEffect(jes, 1.05)
+        ch.addSample(bkg)
+        ch.setObservation(expo_sample(100, 50, mjj))
+
+    cardname = os.path.join(str(tmpdir), 'combModel_combined.txt')
+    model.renderCard(cardname, model.name)
+    with open(cardname) as fin:
+        lines = [line.split() for line in fin]
+    rows = {}
+    for line in lines[1:]:
+        rows.setdefault(line[0], line[1:])
+    assert rows['imax'][0] == '2' and rows['jmax'][0] == '1' and rows['kmax'][0] == '2'
+    assert rows['bin'][:2] == ['sr', 'cr']
+    assert rows['lumi'] == ['lnN'] + ['1.020'] * 4
+    assert rows['jes'] == ['lnN', '-', '-', '-', '1.050']
+    assert [line[1:] for line in lines if line[0] == 'process'][1] == ['0', '1', '0', '1']
+
+
+def _workspaceContents(filename, workspaceName):
+    fin = ROOT.TFile.Open(filename)
+    workspace = fin.Get(workspaceName)
+    contents = sorted(arg.GetName() for arg in workspace.components()) + sorted(data.GetName() for data in workspace.allData())
+    fin.Close()
+    return contents
+
+
+def test_shardedRender(tmpdir):
+    model = rl.Model('shardModel')
+    for i in range(3):
+        model.addChannel(_buildTestChannel(i))
+    outputPath = os.path.join(str(tmpdir), 'shard')
+    model.renderCombine(outputPath, shards=2, processes=1)
+    layout = {'ch0': 'shardModel_shard0', 'ch1': 'shardModel_shard1', 'ch2': 'shardModel_shard0'}
+    for chName, shard in layout.items():
+        assert os.path.exists(os.path.join(outputPath, shard + '.root'))
+        with open(os.path.join(outputPath, chName + '.txt')) as fin:
+            lines = [line.split() for line in fin]
+        shapes = [line for line in lines if line[0] == 'shapes']
+        assert len(shapes) > 0 and all(line[3] == shard + '.root' and line[4].startswith(shard + ':') for line in shapes)
+        extArgs = [line for line in lines if len(line) > 1 and line[1] == 'extArg']
+        assert [line[0] for line in extArgs] == ['tf_mjj_par0', 'tf_mjj_par1', 'tf_mjj_par2']
+        assert all(line[2] == 'shardModel_params.root:shardModel_params' for line in extArgs)
+    assert os.path.exists(os.path.join(outputPath, 'shardModel_params.root'))
+
+    # the same output when rendered in worker processes
+    parallelPath = os.path.join(str(tmpdir), 'shard_parallel')
+    model.renderCombine(parallelPath, shards=2, processes=2)
+    assert sorted(os.listdir(parallelPath)) == sorted(os.listdir(outputPath))
+    for name in ['ch0.txt', 'ch1.txt', 'ch2.txt']:
+        serial, parallel = [open(os.path.join(path, name)).readlines()[1:] for path in [outputPath, parallelPath]]
+        assert serial == parallel
+    for name in ['shardModel_shard0', 'shardModel_shard1']:
+        serial, parallel = [_workspaceContents(os.path.join(path, name + '.root'), name) for path in [outputPath, parallelPath]]
+        assert serial == parallel
+
+    assert model._shardLayout([['ch2'], ['ch0', 'ch1']]) == {'shardModel_shard0': ['ch2'], 'shardModel_shard1': ['ch0', 'ch1']}
+    for shards in [[['ch0', 'ch1'], ['ch1', 'ch2']], [['ch0'], ['ch2']], [['ch0', 'ch1', 'ch2', 'ch3']]]:
+        try:
+            model._shardLayout(shards)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected a ValueError for shards %r" % shards)
+
+
+def test_fingerprint(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    jes = rl.NuisanceParameter('jes', 'shape')
+
+    def build():
+        ch = rl.Channel('sr')
+        bkg = rl.TemplateSample('sr_bkg', rl.Sample.BACKGROUND, expo_sample(100, 50, mjj))
+        bkg.setParamEffect(jes, np.linspace(0.9, 1.1, mjj.nbins))
+        ch.addSample(bkg)
+        yields = np.array([rl.IndependentParameter('sr_qcd_bin%d' % i, 1.) for i in range(mjj.nbins)])
+        ch.addSample(rl.ParametericSample('sr_qcd', rl.Sample.BACKGROUND, mjj, yields))
+        ch.setObservation(expo_sample(120, 50, mjj))
+        return ch
+
+    ch = build()
+    fingerprint = ch.fingerprint()
+    assert build().fingerprint() == fingerprint
+    assert pickle.loads(pickle.dumps(ch)).fingerprint() == fingerprint
+    ch['bkg'].scale(1.1)
+    assert ch.fingerprint() != fingerprint
+    ch = build()
+    ch['qcd'].getExpectation()[0].value = 2.
+    assert ch.fingerprint() != fingerprint
+
+
+def test_incrementalRender(tmpdir):
+    model = rl.Model('incModel')
+    for i in range(2):
+        model.addChannel(_buildTestChannel(i))
+    outputPath = os.path.join(str(tmpdir), 'incremental')
+
+    def card(name):
+        with open(os.path.join(outputPath, name)) as fin:
+            return fin.read()
+
+    def stamp(name):
+        with open(os.path.join(outputPath, name), 'w') as fout:
+            fout.write('untouched')
+
+    model.renderCombine(outputPath, incremental=True)
+    stamp('ch0.txt')
+    stamp('ch1.txt')
+    model['ch1_bkg'].scale(2.)
+    model.renderCombine(outputPath, incremental=True)
+    assert card('ch0.txt') == 'untouched'
+    assert card('ch1.txt') != 'untouched'
+
+    # changing the options or the list of channels renders everything again
+    model.renderCombine(outputPath, combined=True, incremental=True)
+    assert 'imax 2' in card('incModel_combined.txt')
+    stamp('incModel.root')
+    del model._channels['ch1']
+    model.renderCombine(outputPath, combined=True, incremental=True)
+    assert 'imax 1' in card('incModel_combined.txt')
+    assert 'ch1' not in card('incModel_combined.txt')
+    assert card('incModel.root') != 'untouched'
+
+    # a full render neither fingerprints the channels nor leaves a manifest
+    model['ch0'].fingerprint = None
+    model.renderCombine(outputPath, combined=True)
+    assert not os.path.exists(os.path.join(outputPath, 'manifest.json'))
+
+
+def test_templateMorphing(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    jes = rl.NuisanceParameter('jes', 'shape')
+    jer = rl.NuisanceParameter('jer', 'shapeN')
+    ch = rl.Channel('morph')
+    sample = rl.TemplateSample('morph_bkg', rl.Sample.BACKGROUND, expo_sample(100, 50, mjj))
+    sample.RenderMorphing = True
+    sample.setParamEffect(jes, np.linspace(0.9, 1.1, mjj.nbins), np.linspace(1.05, 0.97, mjj.nbins))
+    sample.setParamEffect(jer, np.linspace(1.1, 0.95, mjj.nbins))
+    # scaled effects, with scales large enough that the expectation is not smoothed between the up and down variations at +-1 sigma
+    params = [jes, jer] + [rl.NuisanceParameter(name, prior) for name, prior in [('jesScaled', 'shape'), ('jerScaled', 'shapeN'), ('jerAsymScaled', 'shapeN')]]
+    sample.setParamEffect(params[2], np.linspace(0.9, 1.1, mjj.nbins), np.linspace(1.05, 0.97, mjj.nbins), scale=2.)
+    sample.setParamEffect(params[3], np.linspace(1.1, 0.95, mjj.nbins), scale=2.)
+    sample.setParamEffect(params[4], np.linspace(1.1, 0.95, mjj.nbins), np.linspace(0.97, 1.02, mjj.nbins), scale=1.5)
+    ch.addSample(sample)
+    ch.setObservation(expo_sample(100, 50, mjj))
+
+    ws = ROOT.RooWorkspace('ws')
+    ch.renderRoofit(ws)
+    with warnings.catch_warnings():
+        # the expectation is made of intermediate parameters
+        warnings.simplefilter('ignore', RuntimeWarning)
+        bins = [p.renderRoofit(ws) for p in sample.getExpectation()]
+    morph, norm, x = ws.function('morph_bkg_morph'), ws.function('morph_bkg_norm'), ws.var('mjj')
+    centers = mjj.binning[:-1] + 0.5 * np.diff(mjj.binning)
+    for param in params:
+        for value in [-1., 1.]:
+            ws.var(param.name).setVal(value)
+            expected = np.array([b.getVal() for b in bins])
+            morphed = []
+            for center in centers:
+                x.setVal(center)
+                morphed.append(morph.getVal())
+            assert np.allclose(np.array(morphed) * np.diff(mjj.binning), expected)
+            assert np.isclose(norm.getVal(), expected.sum())
+        ws.var(param.name).setVal(0.)
+
+    cardname = os.path.join(str(tmpdir), 'morph.txt')
+    ch.renderCard(cardname, 'ws')
+    with open(cardname) as fin:
+        card = fin.read()
+    assert all('%s param 0 1' % param.name in card for param in params)
+    # the yield is carried by the norm function
+    assert [line.split() for line in card.splitlines() if line.startswith('rate')] == [['rate', '1.000']]
+    assert ' shape ' not in card and ' shapeN ' not in card
+
+
+def test_maskedBins(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    ch = rl.Channel('sr')
+    jes = rl.NuisanceParameter('jes', 'shapeN')
+    yields = np.array([rl.IndependentParameter('sr_qcd_bin%d' % i, 1.) for i in range(mjj.nbins)])
+    qcd = rl.ParametericSample('sr_qcd', rl.Sample.BACKGROUND, mjj, yields)
+    qcd.setParamEffect(jes, np.full(mjj.nbins, 1.1))
+    ch.addSample(qcd)
+    mask = np.ones(mjj.nbins, dtype=bool)
+    mask[-3:] = False
+    ch.mask = mask
+
+    expectation = qcd.getExpectation()
+    assert all(p is rl.ParametericSample.MaskedBin for p in expectation[~mask])
+    assert qcd.parameters == set(yields[mask]) | {jes}
+    assert np.array_equal(qcd.getExpectation(nominal=True), mask.astype(float))
+
+    # a live bin of a transfer factor sample whose dependent bin is masked
+    model = rl.Model('maskModel')
+    model.addChannel(ch)
+    passCh = rl.Channel('pass')
+    model.addChannel(passCh)
+    passQcd = rl.TransferFactorSample('pass_qcd', rl.Sample.BACKGROUND, np.full(mjj.nbins, 0.5), qcd)
+    passCh.addSample(passQcd)
+    passCh.setObservation(expo_sample(10, 50, mjj))
+    assert rl.ParametericSample.MaskedBin not in passQcd.parameters
+    assert 'rhalphalib_masked_bin' not in model.registry
+    cardname = os.path.join(str(tmpdir), 'pass.txt')
+    passCh.renderCard(cardname, 'ws')
+    with open(cardname) as fin:
+        assert 'rhalphalib_masked_bin' not in fin.read()
+
+
+def test_bernsteinLinearCombination(tmpdir):
+    poly = rl.BernsteinPoly('tf', (2, 3), ['pt', 'rho'], init_params=np.arange(12.).reshape(3, 4))
+    pt, rho = np.meshgrid(np.linspace(0, 1, 5), np.linspace(0, 1, 7), indexing='ij')
+    points = poly(pt, rho)
+    assert points.shape == pt.shape
+    assert all(isinstance(p, rl.LinearCombination) for p in points.reshape(-1))
+    # every point shares the one parameter tensor
+    assert len({id(p._dependents) for p in points.reshape(-1)}) == 1
+    assert points[1, 2].name == 'tf_eval_pt0p250_rho0p333'
+    assert np.allclose([p.value for p in points.reshape(-1)], poly(pt, rho, nominal=True).reshape(-1))
+    # at a corner only one basis polynomial contributes
+    assert points[0, 0].getDependents(rendering=True) == {poly.parameters[0, 0]}
+
+    # parameters with a zero coefficient are not dependents, in any mode
+    a, b, c = (rl.IndependentParameter(name, 1.) for name in 'abc')
+    combination = rl.LinearCombination('comb', [2., 0., 1.], np.array([a, b, c]))
+    combination.intermediate = True
+    assert combination.formula() == '(2.0*{a}+1.0*{c})'
+    for kwargs in [{}, {'rendering': True}, {'deep': True}]:
+        assert combination.getDependents(**kwargs) == {a, c}
+    assert (combination * 2.).getDependents() == {a, c}
+    for args in [([1., 2.], np.array([a, b, c])), ([1., 2.], np.array([a, 2.], dtype=object))]:
+        try:
+            rl.LinearCombination('bad', *args)
+        except ValueError as err:
+            assert 'LinearCombination: ' in str(err)
+        else:
+            raise AssertionError("Expected a ValueError for %r" % (args, ))
+
+
+def test_bernsteinHighOrder(tmpdir):
+    poly = rl.BernsteinPoly('tf', (12, 15), ['pt', 'rho'])
+    x, y = np.random.rand(2, 10000)
+    coef = poly.coefficients(x, y)
+    assert coef.shape == (10000, 13, 16)
+    # the basis is a partition of unity, also at high order
+    assert np.allclose(coef.reshape(10000, -1).sum(axis=1), 1., rtol=0, atol=1e-13)
+    poly.CoefficientChunkSize = 77
+    assert np.array_equal(poly.coefficients(x, y), coef)
+
+
+def test_bernsteinNominal(tmpdir):
+    poly = rl.BernsteinPoly('tf', (3, 2), ['pt', 'rho'], init_params=np.random.rand(4, 3))
+    pt, rho = np.random.rand(2, 20, 5)
+    reference = np.einsum('xij,ij->x', poly.coefficients(pt, rho), poly._init_params)
+    assert np.allclose(poly(pt, rho, nominal=True), reference.reshape(pt.shape))
+    assert len(poly._cache) == 1
+    poly(pt, rho, nominal=True)
+    assert len(poly._cache) == 1
+    for i in range(poly.CoefficientCacheSize):
+        poly(np.full(3, i / 100.), np.zeros(3), nominal=True)
+    assert len(poly._cache) == poly.CoefficientCacheSize
+    # large grids are streamed rather than cached
+    x = np.random.rand(3 * poly.CoefficientChunkSize + 5)
+    chunks = list(poly.coefficients(x, x, chunked=True))
+    assert len(chunks) == 4
+    assert np.allclose(poly(x, x, nominal=True), np.einsum('xij,ij->x', np.concatenate(chunks), poly._init_params))
+
+
+def test_decorrelatedTruncation(tmpdir):
+    eigvals = np.array([1., 0.5, 1e-3, 1e-4, 1e-6])
+    rotation, _ = np.linalg.qr(np.random.rand(5, 5))
+    cov = rotation.dot(np.diag(eigvals)).dot(rotation.T)
+    full = rl.DecorrelatedNuisanceVector('deco', np.ones(5), cov)
+    assert full.parameters.size == 5
+    assert full.discarded_variance_fraction == 0.
+    truncated = rl.DecorrelatedNuisanceVector('deco', np.ones(5), cov, tolerance=1e-3)
+    assert truncated.parameters.size == 2
+    assert np.isclose(truncated.discarded_variance_fraction, (1e-3 + 1e-4 + 1e-6) / eigvals.sum())
+    assert np.isclose(truncated.discarded_variance.sum(), 1e-3 + 1e-4 + 1e-6)
+    for p in truncated.correlated_params:
+        assert isinstance(p, rl.LinearCombination)
+        assert p.getDependents(deep=True) == set(truncated.parameters)
+        assert p.value == 1.
+
+
+def test_decorrelatedBlocks(tmpdir):
+    blockA = np.array([[1., 0.5], [0.5, 2.]])
+    blockB = np.array([[0.3, -0.1, 0.], [-0.1, 0.2, 0.05], [0., 0.05, 0.1]])
+    cov = np.zeros((5, 5))
+    cov[:2, :2] = blockA
+    cov[2:, 2:] = blockB
+    deco = rl.DecorrelatedNuisanceVector('deco', np.zeros(5), cov)
+    assert np.array_equal(deco.blocks, [0, 0, 1, 1, 1])
+    assert np.allclose(deco._transform.T.dot(deco._transform), cov)
+    deps = [p.getDependents(deep=True) for p in deco.correlated_params]
+    assert deps[0] == deps[1] and len(deps[0]) == 2
+    assert deps[2] == deps[3] == deps[4] and len(deps[2]) == 3
+    assert deps[0].isdisjoint(deps[2])
+
+
+def test_lazyTransferFactor(tmpdir):
+    x = rl.Observable('x', np.linspace(0, 1, 5))
+    fail = rl.ParametericSample('fail_qcd', rl.Sample.BACKGROUND, x, np.array([rl.IndependentParameter('fail_bin%d' % i, 1.) for i in range(4)]))
+    tf1d = rl.TransferFactorSample('pass_qcd', rl.Sample.BACKGROUND, np.full(4, 0.5), fail)
+    jes = rl.NuisanceParameter('jes', 'shape')
+    fail.setParamEffect(jes, np.full(4, 1.1))
+    # the dependent sample's effect set after construction is picked up
+    assert jes in tf1d.parameters
+
+    tf = np.full((2, 4), None)
+    tf[0, 0] = 0.5
+    tf[1, 2:] = 0.2, 0
+    tf2d = rl.TransferFactorSample('pass2_qcd', rl.Sample.BACKGROUND, tf, fail, rl.Observable('y', np.linspace(0, 1, 3)))
+    sparse = scipy.sparse.csr_matrix(([0.5, 0.2], ([0, 1], [0, 2])), shape=(2, 4))
+    sparse = rl.TransferFactorSample('pass3_qcd', rl.Sample.BACKGROUND, sparse, fail, tf2d.observable)
+    for sample in [tf2d, sparse]:
+        bins = sample.getExpectation()
+        assert [p.getDependents(deep=True) for p in bins] == [{fail._nominal[0], jes}, {fail._nominal[2], jes}]
+
+    # rebinning the dependent sample invalidates the transfer factor
+    failCh = rl.Channel('fail')
+    failCh.addSample(fail)
+    failCh.mergeBins([[0, 1], [2, 3]])
+    for sample in [tf1d, tf2d, sparse]:
+        try:
+            sample.getExpectation()
+        except RuntimeError as err:
+            assert 'now has 2' in str(err)
+        else:
+            raise AssertionError("Expected a RuntimeError for a rebinned dependent sample")
+    # samples without parameters are rejected, unless a subclass provides them
+    try:
+        rl.ParametericSample('none_qcd', rl.Sample.BACKGROUND, x, None)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected a ValueError for missing parameters")
+
+
+def test_cloneHypotheses(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    lumi = rl.NuisanceParameter('lumi', 'lnN')
+    model = rl.Model('scan')
+    for chName in ['sr', 'cr']:
+        ch = rl.Channel(chName)
+        model.addChannel(ch)
+        bkg = rl.TemplateSample(chName + '_bkg', rl.Sample.BACKGROUND, expo_sample(100, 50, mjj))
+        bkg.setParamEffect(lumi, 1.02)
+        ch.addSample(bkg)
+        ch.setObservation(expo_sample(100, 50, mjj))
+    model['sr'].addSample(rl.TemplateSample('sr_m40', rl.Sample.SIGNAL, gaus_sample(10, 40, 5, mjj)))
+
+    clones = []
+    for mass in [50, 60]:
+        signal = rl.TemplateSample('sr_m%d' % mass, rl.Sample.SIGNAL, gaus_sample(10, mass, 5, mjj))
+        clones.append(model.clone('scan%d' % mass, replace={'sr_m40': signal}))
+        assert clones[-1]['cr'] is model['cr']
+        assert clones[-1]['sr'] is not model['sr']
+        assert clones[-1]['sr_bkg'] is model['sr_bkg']
+        assert [s.name for s in clones[-1]['sr']] == ['sr_bkg', 'sr_m%d' % mass]
+    assert [s.name for s in model['sr']] == ['sr_bkg', 'sr_m40']
+
+    model.renderCombineHypotheses(str(tmpdir), clones)
+    for name in ['scan', 'scan50', 'scan60']:
+        assert os.path.exists(os.path.join(str(tmpdir), name + '_combined.txt'))
+
+
+def test_saveLoad(tmpdir):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    jes = rl.NuisanceParameter('jes', 'shape')
+    model = rl.Model('saveModel')
+    ch = rl.Channel('sr')
+    model.addChannel(ch)
+    sig = rl.TemplateSample('sr_sig', rl.Sample.SIGNAL, gaus_sample(10, 50, 10, mjj))
+    sig.setParamEffect(jes, np.linspace(0.9, 1.1, 10))
+    ch.addSample(sig)
+    qcd = rl.ParametericSample('sr_qcd', rl.Sample.BACKGROUND, mjj, np.array([rl.IndependentParameter('sr_qcd_p%d' % i, 1.) for i in range(10)]))
+    qcd.setParamEffect(jes, np.full(10, 1.05))
+    ch.addSample(qcd)
+    ch.setObservation(expo_sample(100, 50, mjj))
+
+    path = os.path.join(str(tmpdir), 'model.rhl')
+    model.save(path)
+    for mmap_buffers in [True, False]:
+        loaded = rl.Model.load(path, mmap_buffers)
+        assert [c.fingerprint() for c in loaded] == [c.fingerprint() for c in model]
+        assert set(p.name for p in loaded.parameters) == set(p.name for p in model.parameters)
+        # parameters shared between samples stay shared
+        assert loaded['sr_sig']._paramEffectsUp.keys() == loaded['sr_qcd']._paramEffectsUp.keys() == {loaded.registry['jes']}
+
+    # deeper than pickle can handle
+    chain = rl.IndependentParameter('chain', 1.)
+    for i in range(2 * sys.getrecursionlimit()):
+        chain = chain * 1.
+        chain.name = 'chain%d' % i
+    chain = rl.serialize.loads(rl.serialize.dumps(chain))
+    depth = 0
+    while isinstance(chain, rl.DependentParameter):
+        chain = chain._dependents[0]
+        depth += 1
+    assert depth == 2 * sys.getrecursionlimit() and chain.name == 'chain'
+
+
+def _buildTestChannel(i):
+    mjj = rl.Observable('mjj', np.linspace(0, 100, 11))
+    lumi = rl.NuisanceParameter('lumi', 'lnN')
+    tf = rl.BernsteinPoly('tf', (2, ), ['mjj'])
+    ch = rl.Channel('ch%d' % i)
+    bkg = rl.TemplateSample('ch%d_bkg' % i, rl.Sample.BACKGROUND, expo_sample(100 * (i + 1), 50, mjj))
+    bkg.setParamEffect(lumi, 1.02)
+    ch.addSample(bkg)
+    ch.addSample(rl.ParametericSample('ch%d_qcd' % i, rl.Sample.BACKGROUND, mjj, 10. * (i + 1) * tf(np.linspace(0.05, 0.95, 10))))
+    ch.setObservation(expo_sample(100, 50, mjj))
+    return ch
+
+
+def test_parallelBuild(tmpdir):
+    model = rl.Model.fromChannelBuilder('parallel', _buildTestChannel, range(4), processes=2)
+    assert [ch.name for ch in model] == ['ch0', 'ch1', 'ch2', 'ch3']
+    lumi = model.registry['lumi']
+    assert all(list(model['ch%d_bkg' % i]._paramEffectsUp) == [lumi] for i in range(4))
+    # the polynomial coefficients are shared by all channels
+    assert set(p.name for p in model.parameters if p.name.startswith('tf_')) == {'tf_mjj_par0', 'tf_mjj_par1', 'tf_mjj_par2'}
+    assert model['ch0_qcd'].parameters == model['ch3_qcd'].parameters
+
+
+def test_streamingRender(tmpdir):
+    produced = []
+
+    def channels():
+        for i in range(4):
+            ch = _buildTestChannel(i)
+            produced.append(weakref.ref(ch))
+            yield ch
+
+    model = rl.Model('stream')
+    assert model.renderCombineStreaming(str(tmpdir), channels()) == ['ch0', 'ch1', 'ch2', 'ch3']
+    # each channel is released once rendered
+    assert all(ref() is None for ref in produced)
+    for name in ['stream_ch0.root', 'stream_params.root', 'ch3.txt', 'build.sh']:
+        assert os.path.exists(os.path.join(str(tmpdir), name))
+    with open(os.path.join(str(tmpdir), 'ch0.txt')) as fin:
+        assert 'tf_mjj_par0 extArg stream_params.root:stream_params' in fin.read()
+
+
 if __name__ == '__main__':
     if not os.path.exists('tmp'):
         os.mkdir('tmp')